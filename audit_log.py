@@ -0,0 +1,165 @@
+# audit_log.py
+"""
+יומן התאמות (audit trail): איזה שורות נצבעו יחד, באיזה שלב ולמה.
+
+בזמן ההתאמה כל זוג נרשם כ-tuple אחד (שלב, רשומה, רשומה מותאמת) –
+בלי עיצוב ובלי גישה לגיליון. בסוף הריצה היומן נכתב בבת אחת לגיליון
+מוסתר 'יומן התאמות' בקובץ הפלט. בהעלאה חוזרת של קובץ פלט השורות שכבר
+צבועות מדולגות, ולכן הזוגות של הריצה הקודמת נשמרים מהגיליון הקיים
+(read_audit_rows) ונכתבים לפני הזוגות החדשים. אפשר לחפש ביומן שורה:
+
+    python audit_log.py output.xlsx 17 42
+"""
+import sys
+
+import openpyxl
+
+AUDIT_SHEET_TITLE = "יומן התאמות"
+AUDIT_HEADERS = [
+    "זוג",
+    "שלב",
+    "שורה",
+    "חשבון",
+    "סכום",
+    "שורה מותאמת",
+    "חשבון מותאם",
+    "סכום מותאם",
+    "הפרש",
+]
+
+# עיגול ההפרש – מעלים רעש של float (100.1 - 100 = 0.0999...)
+DIFF_DIGITS = 6
+
+
+def read_audit_rows(wb):
+    """
+    שורות היומן שכבר בקובץ (בלי מספר הזוג, שממוספר מחדש בכתיבה);
+    [] אם אין בקובץ גיליון יומן. עובד גם על Workbook ב-read_only.
+    """
+    if AUDIT_SHEET_TITLE not in wb.sheetnames:
+        return []
+    width = len(AUDIT_HEADERS)
+    rows = []
+    for r in wb[AUDIT_SHEET_TITLE].iter_rows(min_row=2, max_col=width, values_only=True):
+        if r and r[0] is not None:
+            rows.append(tuple(r[1:]) + (None,) * (width - len(r)))
+    return rows
+
+
+def _pair_key(row):
+    """(שלב, שורה, שורה מותאמת) של שורת יומן בלי מספר הזוג."""
+    return row[0], row[1], row[4] if len(row) > 4 else None
+
+
+class PairLog:
+    """
+    יומן הזוגות של ריצה אחת, לפי סדר ההתאמה (דטרמיניסטי).
+    entries – [(אינדקס שלב, רשומה, רשומה מותאמת או None)];
+    הלולאות מוסיפות ישירות עם entries.append.
+    prior – שורות מריצה קודמת (read_audit_rows). זוג שהותאם שוב באותו שלב
+    (למשל 'התאמה 100%', שלא מדלגת על שורות צבועות) נכתב פעם אחת בלבד.
+    """
+
+    def __init__(self, prior=()):
+        self.stages = []
+        self.entries = []
+        self.prior = list(prior)
+
+    def add_stage(self, name):
+        """רושם שלב (כלל התאמה) ומחזיר את האינדקס שלו."""
+        self.stages.append(name)
+        return len(self.stages) - 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _entry_rows(self):
+        stages = self.stages
+        for stage, rec, other in self.entries:
+            if other is None:
+                yield (stages[stage], rec.row, rec.acc, rec.amount)
+                continue
+            diff = None
+            if rec.amount is not None and other.amount is not None:
+                diff = round(rec.amount + other.amount, DIFF_DIGITS)
+            yield (
+                stages[stage],
+                rec.row,
+                rec.acc,
+                rec.amount,
+                other.row,
+                other.acc,
+                other.amount,
+                diff,
+            )
+
+    def sheet_rows(self):
+        """שורות הגיליון (כולל כותרת): קודם הזוגות מהריצות הקודמות, אחר כך החדשים."""
+        new = list(self._entry_rows())
+        seen = {_pair_key(r) for r in new}
+        merged = [r for r in self.prior if _pair_key(r) not in seen] + new
+        rows = [AUDIT_HEADERS]
+        for pair_no, r in enumerate(merged, start=1):
+            rows.append([pair_no, *r])
+        return rows
+
+    def index(self):
+        """PairIndex על היומן שבזיכרון."""
+        return PairIndex(self.sheet_rows()[1:])
+
+
+class PairIndex:
+    """חיפוש מהיר ביומן לפי מספר שורה בגיול (שני צדי הזוג)."""
+
+    def __init__(self, rows):
+        self.rows = [tuple(r) + (None,) * (len(AUDIT_HEADERS) - len(r)) for r in rows]
+        self.by_row = {}
+        for i, r in enumerate(self.rows):
+            self.by_row.setdefault(r[2], []).append(i)
+            if r[5] is not None:
+                self.by_row.setdefault(r[5], []).append(i)
+
+    @classmethod
+    def from_workbook(cls, wb):
+        if AUDIT_SHEET_TITLE not in wb.sheetnames:
+            raise ValueError(f"בקובץ אין גיליון '{AUDIT_SHEET_TITLE}'.")
+        ws = wb[AUDIT_SHEET_TITLE]
+        return cls(
+            r for r in ws.iter_rows(min_row=2, values_only=True) if r and r[0] is not None
+        )
+
+    @classmethod
+    def from_file(cls, path):
+        wb = openpyxl.load_workbook(path, read_only=True)
+        try:
+            return cls.from_workbook(wb)
+        finally:
+            wb.close()
+
+    def lookup(self, row):
+        """כל רשומות היומן שבהן מופיעה השורה, כמילונים לפי AUDIT_HEADERS."""
+        return [dict(zip(AUDIT_HEADERS, self.rows[i])) for i in self.by_row.get(row, ())]
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) < 2:
+        print("שימוש: python audit_log.py <קובץ פלט.xlsx> <שורה> [<שורה> ...]")
+        return 2
+
+    index = PairIndex.from_file(argv[0])
+    for arg in argv[1:]:
+        row = int(arg)
+        found = index.lookup(row)
+        if not found:
+            print(f"שורה {row}: לא נצבעה ע\"י אף שלב")
+            continue
+        for entry in found:
+            print(f"שורה {row}: " + ", ".join(
+                f"{k}={v}" for k, v in entry.items() if v is not None
+            ))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
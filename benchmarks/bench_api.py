@@ -0,0 +1,333 @@
+# benchmarks/bench_api.py
+"""
+בדיקת עומס ל-/process של main.py: worker אחד של uvicorn על localhost.
+
+כל רמת מקביליות שולחת את אותו תמהיל של דוחות גיול סינתטיים (בגדלים שונים)
+ומודדת latency (p50/p95/p99), throughput ו-RSS של תהליך ה-worker, וגם
+latency לכל גודל דוח בנפרד (p50/p95) – בתמהיל אחד ה-p95 נשלט ע"י הדוח הגדול.
+ב-nearest-rank, p99 שונה מהמקסימום רק מ-101 בקשות ומעלה, ולכן ברירת המחדל
+היא 120 בקשות לרמה (40 לכל גודל). הרצה מתיקיית הרפו:
+
+    python -m benchmarks.bench_api --concurrency 1,2,4,8 --requests 120
+    python -m benchmarks.bench_api --save benchmarks/baseline_api.json
+    python -m benchmarks.bench_api --compare benchmarks/baseline_api.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.synthetic import make_aging_report_bytes, make_helper_bytes
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# מדדי latency שנבדקים מול ה-baseline
+LATENCY_KEYS = ("p50_s", "p95_s", "p99_s")
+SIZE_LATENCY_KEYS = ("p50_s", "p95_s")
+
+
+# ---------- שרת ----------
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, timeout=30):
+    """מרים uvicorn main:app (worker יחיד) ומחכה ש-/health יענה."""
+    proc = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--host", "127.0.0.1",
+            "--port", str(port),
+            "--log-level", "warning",
+        ],
+        cwd=REPO_ROOT,
+    )
+    url = f"http://127.0.0.1:{port}/health"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"uvicorn יצא עם קוד {proc.returncode}")
+        try:
+            if requests.get(url, timeout=1).ok:
+                return proc
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("uvicorn לא עלה בזמן")
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def rss_mb(pid):
+    """RSS נוכחי של תהליך מ-/proc (Linux). None אם לא זמין."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+class RssSampler:
+    """דוגם RSS של ה-worker ברקע ושומר את השיא."""
+
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            value = rss_mb(self.pid)
+            if value is not None and (self.peak is None or value > self.peak):
+                self.peak = value
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+# ---------- עומס ----------
+
+def percentile(sorted_values, q):
+    """אחוזון בשיטת nearest-rank על רשימה ממוינת."""
+    if not sorted_values:
+        return None
+    k = max(0, math.ceil(q / 100 * len(sorted_values)) - 1)
+    return sorted_values[k]
+
+
+def build_payloads(sizes, columns, seed):
+    """קובץ גיול אחד לכל גודל + קובץ עזר משותף."""
+    payloads = {
+        n: make_aging_report_bytes(n, n_columns=columns, seed=seed) for n in sizes
+    }
+    helper = make_helper_bytes(max(1, max(sizes) // 10), seed=seed)
+    return payloads, helper
+
+
+def schedule(sizes, n_requests, seed):
+    """סדר הגדלים לשליחה – זהה בכל רמת מקביליות ובכל הרצה."""
+    order = [sizes[i % len(sizes)] for i in range(n_requests)]
+    random.Random(seed).shuffle(order)
+    return order
+
+
+def send(url, ledger_bytes, helper_bytes, output_mode):
+    files = {
+        "file1": ("aging.xlsx", ledger_bytes, XLSX_MEDIA_TYPE),
+        "file2": ("helper.xlsx", helper_bytes, XLSX_MEDIA_TYPE),
+    }
+    t0 = time.perf_counter()
+    resp = requests.post(url, files=files, data={"output_mode": output_mode}, timeout=600)
+    elapsed = time.perf_counter() - t0
+    return elapsed, resp.status_code
+
+
+def run_level(url, pid, concurrency, order, payloads, helper, output_mode):
+    latencies, errors = [], 0
+    by_size = {n: [] for n in payloads}
+    with RssSampler(pid) as sampler, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        t0 = time.perf_counter()
+        futures = [
+            pool.submit(send, url, payloads[n], helper, output_mode) for n in order
+        ]
+        for n, fut in zip(order, futures):
+            try:
+                elapsed, status = fut.result()
+            except requests.RequestException:
+                errors += 1
+                continue
+            if status == 200:
+                latencies.append(elapsed)
+                by_size[n].append(elapsed)
+            else:
+                errors += 1
+        wall = time.perf_counter() - t0
+
+    latencies.sort()
+    sizes = {}
+    for n, values in sorted(by_size.items()):
+        values.sort()
+        # מפתח מחרוזת – כך הוא נשמר ונטען מ-JSON
+        sizes[str(n)] = {
+            "requests": len(values),
+            "p50_s": percentile(values, 50),
+            "p95_s": percentile(values, 95),
+        }
+    return {
+        "concurrency": concurrency,
+        "requests": len(order),
+        "errors": errors,
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "p99_s": percentile(latencies, 99),
+        "throughput_rps": len(latencies) / wall if wall else None,
+        "rss_peak_mb": sampler.peak,
+        "by_size": sizes,
+    }
+
+
+# ---------- baseline ----------
+
+def compare(result, baseline, tolerance):
+    """מחזיר רשימת רגרסיות (מחרוזות) מול baseline עם אותה קונפיגורציה."""
+    problems = []
+    if result["config"] != baseline["config"]:
+        problems.append("הקונפיגורציה שונה מה-baseline – ההשוואה לא תקפה")
+        return problems
+
+    base_levels = {lvl["concurrency"]: lvl for lvl in baseline["levels"]}
+    for lvl in result["levels"]:
+        base = base_levels.get(lvl["concurrency"])
+        if base is None:
+            continue
+        c = lvl["concurrency"]
+        if lvl["errors"] > base["errors"]:
+            problems.append(f"c={c}: errors {base['errors']} -> {lvl['errors']}")
+        for key in LATENCY_KEYS + ("rss_peak_mb",):
+            if base[key] and lvl[key] and lvl[key] > base[key] * (1 + tolerance):
+                problems.append(f"c={c}: {key} {base[key]:.2f} -> {lvl[key]:.2f}")
+        base_sizes = base.get("by_size", {})
+        for n, stats in lvl["by_size"].items():
+            base_stats = base_sizes.get(n)
+            if base_stats is None:
+                continue
+            for key in SIZE_LATENCY_KEYS:
+                old, new = base_stats[key], stats[key]
+                if old and new and new > old * (1 + tolerance):
+                    problems.append(f"c={c} n={n}: {key} {old:.2f} -> {new:.2f}")
+        if (
+            base["throughput_rps"]
+            and lvl["throughput_rps"] is not None
+            and lvl["throughput_rps"] < base["throughput_rps"] * (1 - tolerance)
+        ):
+            problems.append(
+                f"c={c}: throughput_rps {base['throughput_rps']:.2f} -> {lvl['throughput_rps']:.2f}"
+            )
+    return problems
+
+
+def _fmt(value, spec=".3f"):
+    return "-" if value is None else format(value, spec)
+
+
+def print_table(result):
+    print("concurrency\trequests\terrors\tp50_s\tp95_s\tp99_s\trps\trss_peak_mb")
+    for lvl in result["levels"]:
+        print(
+            f"{lvl['concurrency']}\t{lvl['requests']}\t{lvl['errors']}\t"
+            f"{_fmt(lvl['p50_s'])}\t{_fmt(lvl['p95_s'])}\t{_fmt(lvl['p99_s'])}\t"
+            f"{_fmt(lvl['throughput_rps'], '.2f')}\t{_fmt(lvl['rss_peak_mb'], '.1f')}"
+        )
+        for n, stats in lvl["by_size"].items():
+            print(
+                f"  n={n}\t{stats['requests']}\t\t"
+                f"{_fmt(stats['p50_s'])}\t{_fmt(stats['p95_s'])}"
+            )
+
+
+def _int_list(text):
+    return [int(x) for x in text.split(",") if x.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 2, 4, 8])
+    parser.add_argument("--requests", type=int, default=120, help="בקשות לכל רמת מקביליות")
+    parser.add_argument("--sizes", type=_int_list, default=[500, 2000, 8000], help="שורות בדוח")
+    parser.add_argument("--columns", type=int, default=20)
+    parser.add_argument("--output-mode", default="patch")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="שמירת התוצאה כ-JSON (baseline)")
+    parser.add_argument("--compare", help="השוואה ל-baseline; קוד יציאה 1 על רגרסיה")
+    # מכונות משותפות רועשות; רגרסיה אמיתית (למשל קריסת מקביליות) גדולה בהרבה
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    args = parser.parse_args()
+
+    config = {
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "sizes": args.sizes,
+        "columns": args.columns,
+        "output_mode": args.output_mode,
+        "seed": args.seed,
+    }
+    payloads, helper = build_payloads(args.sizes, args.columns, args.seed)
+    order = schedule(args.sizes, args.requests, args.seed)
+
+    port = _free_port()
+    proc = start_server(port)
+    url = f"http://127.0.0.1:{port}/process"
+    try:
+        # חימום: imports ו-cache של ה-worker לא נכנסים למדידה
+        send(url, payloads[min(args.sizes)], helper, args.output_mode)
+        idle_rss = rss_mb(proc.pid)
+        levels = [
+            run_level(url, proc.pid, c, order, payloads, helper, args.output_mode)
+            for c in args.concurrency
+        ]
+    finally:
+        stop_server(proc)
+
+    result = {
+        "config": config,
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "idle_rss_mb": idle_rss,
+        "levels": levels,
+    }
+    print(json.dumps(config, ensure_ascii=False))
+    print_table(result)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        problems = compare(result, baseline, args.tolerance)
+        for p in problems:
+            print(f"REGRESSION {p}")
+        if problems:
+            sys.exit(1)
+        print("OK – אין רגרסיה מול", args.compare)
+
+
+if __name__ == "__main__":
+    main()
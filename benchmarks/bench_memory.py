@@ -0,0 +1,124 @@
+# benchmarks/bench_memory.py
+"""
+בנצ'מרק זיכרון: החזקת tuples מלאים של openpyxl מול רשומות LedgerRow.
+
+כל מצב רץ בתהליך נפרד כדי ש-peak RSS (ru_maxrss) לא יתערבב בין המצבים.
+הרצה מתיקיית הרפו:
+
+    python -m benchmarks.bench_memory --rows 50000 --columns 45
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+
+import openpyxl
+
+from benchmarks.synthetic import make_aging_report
+from streamlit_app import (
+    detect_headers,
+    load_ledger_rows,
+    parse_amount,
+)
+
+MODES = ("rows", "records")
+
+
+def _peak_rss_mb():
+    # ב-Linux ru_maxrss ביחידות KB, ב-macOS ב-bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def _hold_rows(ws, data_start_row, col_acc, col_amt):
+    """הדפוס הישן: groups / pos / neg / eligible מחזיקים tuples של תאים."""
+    groups = defaultdict(list)
+    for row in ws.iter_rows(min_row=data_start_row):
+        groups[row[col_acc - 1].value].append(row)
+
+    pos, neg, eligible = [], [], []
+    for row in ws.iter_rows(min_row=data_start_row):
+        try:
+            v = parse_amount(row[col_amt - 1].value)
+        except Exception:
+            continue
+        if v > 0:
+            pos.append((v, row))
+        elif v < 0:
+            neg.append((v, row))
+        if v != 0:
+            eligible.append((v, row[col_acc - 1].value, row))
+    return groups, pos, neg, eligible
+
+
+def _hold_records(ws, data_start_row, headers):
+    """הדפוס החדש: רשימת LedgerRow אחת והפניות אליה."""
+    records, _ = load_ledger_rows(
+        ws,
+        data_start_row,
+        col_acc=headers["חשבון"],
+        col_amt=headers["חוב לחשבונית"],
+        col_type=headers.get("סוג תנועה"),
+        col_name=headers.get("תאור חשבון", 3),
+        col_pay=headers.get("תאריך תשלום", 4),
+    )
+    groups = defaultdict(list)
+    for rec in records:
+        groups[rec.acc].append(rec)
+    pos = [rec for rec in records if rec.amount is not None and rec.amount > 0]
+    neg = [rec for rec in records if rec.amount is not None and rec.amount < 0]
+    eligible = [rec for rec in records if rec.amount]
+    return groups, pos, neg, eligible
+
+
+def _child(mode, path):
+    wb = openpyxl.load_workbook(path)
+    ws = wb.active
+    header_row, headers = detect_headers(ws)
+    loaded = _peak_rss_mb()
+
+    if mode == "rows":
+        held = _hold_rows(ws, header_row + 1, headers["חשבון"], headers["חוב לחשבונית"])
+    else:
+        held = _hold_records(ws, header_row + 1, headers)
+
+    peak = _peak_rss_mb()
+    print(f"{mode}\t{loaded:.1f}\t{peak:.1f}\t{peak - loaded:.1f}")
+    return held
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--columns", type=int, default=45)
+    parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child(args.child, args.path)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "aging.xlsx")
+        make_aging_report(args.rows, n_columns=args.columns).save(path)
+
+        print(f"rows={args.rows} columns={args.columns}")
+        print("mode\tloaded_mb\tpeak_mb\tdelta_mb")
+        for mode in MODES:
+            out = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_memory", "--child", mode, "--path", path],
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+            sys.stdout.write(out.stdout)
+
+
+if __name__ == "__main__":
+    main()
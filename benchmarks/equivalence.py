@@ -0,0 +1,442 @@
+# benchmarks/equivalence.py
+"""
+בדיקת שקילות: process_file (מנוע הכללים + patch / openpyxl) מול המימוש
+המקורי של process_workbook (עותק קפוא למטה) על גיולים אקראיים.
+
+הגיולים כוללים: סכומים לא תקינים/ריקים, תאי סכום חסרים ב-XML (מסלול
+ההכנסה ב-xlsx_patch), תאים שכבר צבועים, 'העב' עם רווחים, תג <dimension>
+שגוי (קטן מהגיליון בפועל) והעלאה חוזרת של קובץ פלט. משווים ערך + מילוי
+של כל תא בכל הגיליונות שהיו גם במימוש המקורי; גיליונות חדשים ('גיול פתוח',
+'יומן התאמות') ועמודת 'סוג התאמה' בגיליון המיילים לא נבדקים כאן. הרצה מתיקיית הרפו:
+
+    python -m benchmarks.equivalence --cases 600
+"""
+import argparse
+import io
+import random
+import re
+import sys
+import zipfile
+from collections import defaultdict
+from datetime import datetime
+
+import openpyxl
+from openpyxl.styles import Alignment, PatternFill
+
+from streamlit_app import (
+    AGING_SHEET_TITLE,
+    AUDIT_SHEET_TITLE,
+    MAIL_SHEET_TITLE,
+    OUTPUT_MODES,
+    detect_headers,
+    parse_amount,
+    process_file,
+)
+
+# גיליונות שלא היו במימוש המקורי
+NEW_SHEETS = {AGING_SHEET_TITLE, AUDIT_SHEET_TITLE}
+# במימוש המקורי בגיליון המיילים היו 3 עמודות (בלי 'סוג התאמה')
+REFERENCE_MAIL_COLUMNS = 3
+
+# רק מפתח חשבון מדויק – ההתאמה המנורמלת/הדומה של EmailIndex היא תוספת
+EMAIL_MAPPING = {"1": "one@example.com"}
+
+PREFILL_RGBS = ["FF00FF00", "FFFFA500", "FFCC99FF", "FFADD8E6", "FF123456"]
+
+
+# ---------- המימוש המקורי (קפוא) ----------
+
+_GREEN_RGB = "FF00FF00"
+_ORANGE_RGB = "FFFFA500"
+_PURPLE_RGB = "FFCC99FF"
+_BLUE_RGB = "FFADD8E6"
+
+_GREEN_FILL = PatternFill(start_color=_GREEN_RGB, end_color=_GREEN_RGB, fill_type="solid")
+_ORANGE_FILL = PatternFill(start_color=_ORANGE_RGB, end_color=_ORANGE_RGB, fill_type="solid")
+_PURPLE_FILL = PatternFill(start_color=_PURPLE_RGB, end_color=_PURPLE_RGB, fill_type="solid")
+_BLUE_FILL = PatternFill(start_color=_BLUE_RGB, end_color=_BLUE_RGB, fill_type="solid")
+
+
+def _has_any_color(cell):
+    try:
+        rgb = cell.fill.start_color.rgb
+    except Exception:
+        rgb = None
+    return cell.fill.fill_type == "solid" and rgb in {
+        _GREEN_RGB,
+        _ORANGE_RGB,
+        _PURPLE_RGB,
+        _BLUE_RGB,
+    }
+
+
+def _ensure_summary_sheet(wb, title, counts):
+    if title in wb.sheetnames:
+        ws_sum = wb[title]
+        for row in ws_sum.iter_rows():
+            for c in row:
+                c.value = None
+    else:
+        ws_sum = wb.create_sheet(title)
+
+    ws_sum["A1"] = "מס ספק"
+    ws_sum["B1"] = "כמות שורות מותאמות"
+
+    r = 2
+    for acc, cnt in counts.items():
+        if acc is None or cnt <= 0:
+            continue
+        ws_sum.cell(r, 1, acc)
+        ws_sum.cell(r, 2, cnt)
+        r += 1
+
+
+def reference_process_workbook(wb, email_mapping=None):
+    """process_workbook כפי שהיה לפני מנוע הכללים – O(n²), על תאי openpyxl."""
+    ws = wb.active
+
+    header_row, headers = detect_headers(ws)
+
+    col_acc = headers.get("חשבון")
+    col_amt = headers.get("חוב לחשבונית")
+    col_type = headers.get("סוג תנועה")
+    col_name = headers.get("תאור חשבון") or headers.get("שם ספק") or headers.get("תיאור חשבון")
+    col_pay = headers.get("תאריך תשלום")
+
+    if col_acc is None or col_amt is None:
+        raise ValueError("לא נמצאו עמודות 'חשבון' ו/או 'חוב לחשבונית'.")
+
+    if col_name is None:
+        col_name = 3
+    if col_pay is None:
+        col_pay = 4
+
+    data_start_row = header_row + 1
+    company_name = ws["C1"].value if ws["C1"].value is not None else ""
+
+    # לוגיקה 1 – ירוק
+    groups = defaultdict(list)
+    for row in ws.iter_rows(min_row=data_start_row):
+        groups[row[col_acc - 1].value].append(row)
+
+    green_counts = defaultdict(int)
+    for acc, rows in groups.items():
+        pos, neg = [], []
+        for r in rows:
+            try:
+                v = parse_amount(r[col_amt - 1].value)
+            except Exception:
+                continue
+            if v > 0:
+                pos.append((v, r))
+            elif v < 0:
+                neg.append((v, r))
+        used_neg = set()
+        for pval, prow in pos:
+            for ni, (nval, nrow) in enumerate(neg):
+                if ni in used_neg:
+                    continue
+                if abs(pval + nval) < 1e-6:
+                    prow[col_amt - 1].fill = _GREEN_FILL
+                    nrow[col_amt - 1].fill = _GREEN_FILL
+                    green_counts[acc] += 2
+                    used_neg.add(ni)
+                    break
+    _ensure_summary_sheet(wb, "התאמה 100%", green_counts)
+
+    # לוגיקה 3 – כתום
+    orange_counts = defaultdict(int)
+    for acc, rows in groups.items():
+        pos, neg = [], []
+        for r in rows:
+            cell = r[col_amt - 1]
+            if _has_any_color(cell):
+                continue
+            try:
+                v = parse_amount(cell.value)
+            except Exception:
+                continue
+            if v > 0:
+                pos.append((v, r))
+            elif v < 0:
+                neg.append((v, r))
+        used_neg = set()
+        for pval, prow in pos:
+            pc = prow[col_amt - 1]
+            if _has_any_color(pc):
+                continue
+            for ni, (nval, nrow) in enumerate(neg):
+                if ni in used_neg:
+                    continue
+                nc = nrow[col_amt - 1]
+                if _has_any_color(nc):
+                    continue
+                if abs(pval + nval) <= 2:
+                    pc.fill = _ORANGE_FILL
+                    nc.fill = _ORANGE_FILL
+                    orange_counts[acc] += 2
+                    used_neg.add(ni)
+                    break
+    _ensure_summary_sheet(wb, "התאמה 80%", orange_counts)
+
+    # לוגיקה 5 – סגול גלובלי
+    purple_counts = defaultdict(int)
+    eligible = []
+    for row in ws.iter_rows(min_row=data_start_row):
+        cell = row[col_amt - 1]
+        if _has_any_color(cell):
+            continue
+        try:
+            v = parse_amount(cell.value)
+        except Exception:
+            continue
+        if v == 0:
+            continue
+        eligible.append((v, row[col_acc - 1].value, row))
+
+    pos = [x for x in eligible if x[0] > 0]
+    neg = [x for x in eligible if x[0] < 0]
+    used_pos, used_neg = set(), set()
+    for pi, (pval, pacc, prow) in enumerate(pos):
+        if pi in used_pos:
+            continue
+        pc = prow[col_amt - 1]
+        if _has_any_color(pc):
+            continue
+        for ni, (nval, nacc, nrow) in enumerate(neg):
+            if ni in used_neg:
+                continue
+            nc = nrow[col_amt - 1]
+            if _has_any_color(nc):
+                continue
+            if abs(pval + nval) <= 2:
+                pc.fill = _PURPLE_FILL
+                nc.fill = _PURPLE_FILL
+                used_pos.add(pi)
+                used_neg.add(ni)
+                purple_counts[pacc] += 1
+                purple_counts[nacc] += 1
+                break
+    _ensure_summary_sheet(wb, "בדיקת ספקים", purple_counts)
+
+    # לוגיקה 6 – כחול 'העב'
+    rows_mail = []
+    for row in ws.iter_rows(min_row=data_start_row):
+        if col_type is None:
+            continue
+        tval = row[col_type - 1].value
+        tval = str(tval).strip() if tval is not None else ""
+        cell = row[col_amt - 1]
+        if tval == "העב" and not _has_any_color(cell):
+            cell.fill = _BLUE_FILL
+            rows_mail.append(
+                (
+                    row[col_name - 1].value,
+                    row[col_pay - 1].value,
+                    row[col_amt - 1].value,
+                    row[col_acc - 1].value,
+                )
+            )
+
+    # לוגיקה 7 – מיילים לספק
+    grouped_mail = defaultdict(list)
+    for name, pay, debt, acc in rows_mail:
+        grouped_mail[str(acc).strip()].append((name, pay, debt))
+
+    if "מיילים לספק" in wb.sheetnames:
+        ws_mail = wb["מיילים לספק"]
+        for r in ws_mail.iter_rows():
+            for c in r:
+                c.value = None
+    else:
+        ws_mail = wb.create_sheet("מיילים לספק")
+
+    ws_mail["A1"] = "שם ספק"
+    ws_mail["B1"] = "טקסט מייל"
+    ws_mail["C1"] = "מייל ספק"
+
+    row_idx = 2
+    for acc, entries in grouped_mail.items():
+        name = entries[0][0]
+        lines = []
+        for _, pay, debt in entries:
+            if isinstance(pay, datetime):
+                date_str = pay.strftime("%d/%m/%y")
+            else:
+                date_str = str(pay) if pay else ""
+            try:
+                amount = abs(parse_amount(debt))
+            except Exception:
+                amount = debt
+            lines.append(f"תאריך - {date_str}\nעל סכום - {amount}")
+        combined_details = "\n".join(lines)
+        msg = (
+            f"שלום ל-{name}\n"
+            f"חסרות לנו חשבוניות עבור תשלום:\n"
+            f"{combined_details}\n"
+            f"בתודה מראש,\n"
+            f"הנהלת חשבונות של {company_name}"
+        )
+        ws_mail.cell(row_idx, 1, name)
+        ws_mail.cell(row_idx, 2, msg).alignment = Alignment(wrap_text=True)
+        supplier_email = ""
+        if email_mapping:
+            supplier_email = email_mapping.get(acc, "")
+            if not supplier_email and name:
+                supplier_email = email_mapping.get(str(name).strip(), "")
+        if supplier_email:
+            ws_mail.cell(row_idx, 3, supplier_email)
+        row_idx += 1
+
+    for sh in wb.worksheets:
+        sh.sheet_view.rightToLeft = True
+    return wb
+
+
+# ---------- גיולים אקראיים ----------
+
+def make_case(seed):
+    """גיול אקראי קטן (bytes). שורה 1 – כותרות, כך ש-C1 הוא 'שם החברה'."""
+    rnd = random.Random(seed)
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(["חשבון", "תאור חשבון", "תאריך תשלום", "סוג תנועה", "חוב לחשבונית"])
+    for _ in range(rnd.randint(1, 120)):
+        acc = rnd.choice(["1", "2", "3", None, 4.0])
+        amount = rnd.choice([
+            None,   # אין תא סכום ב-XML – מסלול ההכנסה ב-patch
+            "",
+            "abc",
+            0,
+            "1,000",
+            rnd.choice([1, -1]) * rnd.choice(
+                [100, 102, 98, 101.999999, 2, 0.5, 1000, 1002.0000001, 100.0000001, 99.99999999]
+            ),
+        ])
+        pay = rnd.choice([None, "31/12/24", datetime(2025, rnd.randint(1, 12), rnd.randint(1, 28))])
+        ws.append([acc, f"n{acc}", pay, rnd.choice(["העב", "x", " העב "]), amount])
+        if rnd.random() < 0.1:
+            rgb = rnd.choice(PREFILL_RGBS)
+            ws.cell(ws.max_row, 5).fill = PatternFill(
+                start_color=rgb, end_color=rgb, fill_type="solid"
+            )
+    out = io.BytesIO()
+    wb.save(out)
+    return out.getvalue()
+
+
+def with_stale_dimension(data, ref="A1:E3"):
+    """
+    אותו קובץ עם תג <dimension> שגוי בגיליון הראשון, כמו שכותבים חלק מכלי
+    הייצוא. openpyxl ב-read_only סומך על התג ועוצר בשורה האחרונה שבו.
+    """
+    src = zipfile.ZipFile(io.BytesIO(data))
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as dst:
+        for info in src.infolist():
+            part = src.read(info)
+            if info.filename == "xl/worksheets/sheet1.xml":
+                part = re.sub(rb'<dimension ref="[^"]*"', f'<dimension ref="{ref}"'.encode(), part)
+            dst.writestr(info, part)
+    return out.getvalue()
+
+
+# ---------- השוואה ----------
+
+def snapshot(wb):
+    """(שם גיליון, [(ערך, סוג מילוי, צבע)...]) לכל גיליון שהיה במימוש המקורי."""
+    out = []
+    for ws in wb.worksheets:
+        if ws.title in NEW_SHEETS:
+            continue
+        width = REFERENCE_MAIL_COLUMNS if ws.title == MAIL_SHEET_TITLE else None
+        rows = []
+        for row in ws.iter_rows():
+            rows.append([
+                (c.value, c.fill.fill_type, c.fill.start_color.rgb if c.fill.fill_type else None)
+                for c in row
+            ][:width])
+        # שורות ריקות בסוף (מגיליון שרוקן) לא משנות
+        while rows and all(v is None and f is None for v, f, _ in rows[-1]):
+            rows.pop()
+        out.append((ws.title, rows))
+    return out
+
+
+def _reference_bytes(data):
+    wb = reference_process_workbook(openpyxl.load_workbook(io.BytesIO(data)), EMAIL_MAPPING)
+    out = io.BytesIO()
+    wb.save(out)
+    return out.getvalue()
+
+
+def _first_diff(a, b):
+    for (ta, ra), (tb, rb) in zip(a, b):
+        if ta != tb:
+            return f"sheet order: {ta!r} != {tb!r}"
+        for i, (x, y) in enumerate(zip(ra, rb), start=1):
+            if x != y:
+                return f"{ta} row {i}:\n  reference {x}\n  new       {y}"
+        if len(ra) != len(rb):
+            return f"{ta}: {len(ra)} rows != {len(rb)} rows"
+    return f"{len(a)} sheets != {len(b)} sheets"
+
+
+def check_case(seed, reupload=False, stale_dimension=False):
+    """מחזיר None אם זהה, אחרת תיאור ההבדל הראשון."""
+    data = make_case(seed)
+    if stale_dimension:
+        data = with_stale_dimension(data)
+    expected = _reference_bytes(data)
+    if reupload:
+        expected = _reference_bytes(expected)
+    want = snapshot(openpyxl.load_workbook(io.BytesIO(expected)))
+
+    for mode in OUTPUT_MODES:
+        got_bytes = process_file(data, EMAIL_MAPPING, output_mode=mode)
+        if reupload:
+            got_bytes = process_file(got_bytes, EMAIL_MAPPING, output_mode=mode)
+        got = snapshot(openpyxl.load_workbook(io.BytesIO(got_bytes)))
+        if got != want:
+            label = f"seed={seed} mode={mode}"
+            if reupload:
+                label += " reupload"
+            if stale_dimension:
+                label += " stale-dimension"
+            return f"{label}: {_first_diff(want, got)}"
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--cases", type=int, default=600)
+    parser.add_argument("--seed", type=int, default=0, help="seed של המקרה הראשון")
+    parser.add_argument(
+        "--reupload-every", type=int, default=10, help="כל כמה מקרים לבדוק גם העלאה חוזרת"
+    )
+    parser.add_argument(
+        "--stale-dimension-every",
+        type=int,
+        default=10,
+        help="כל כמה מקרים לבדוק גם תג <dimension> שגוי",
+    )
+    args = parser.parse_args()
+
+    failures = 0
+    for seed in range(args.seed, args.seed + args.cases):
+        diffs = [check_case(seed)]
+        if args.reupload_every and seed % args.reupload_every == 0:
+            diffs.append(check_case(seed, reupload=True))
+        if args.stale_dimension_every and seed % args.stale_dimension_every == 5:
+            diffs.append(check_case(seed, stale_dimension=True))
+        for diff in filter(None, diffs):
+            failures += 1
+            print(diff)
+
+    print(f"{args.cases} cases, {failures} mismatches")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# benchmarks/synthetic.py
+"""
+יצירת דוחות גיול סינתטיים לבנצ'מרקים.
+המבנה זהה לייצוא האמיתי (שורה 1 – שם חברה ב-C1, שורה 2 – כותרות).
+"""
+import io
+import random
+from datetime import datetime
+
+import openpyxl
+
+BASE_HEADERS = [
+    "מטבע",
+    "חשבון",
+    "תאור חשבון",
+    "תאריך תשלום",
+    "ימי פיגור",
+    "חשבונית",
+    "חש. ספק",
+    "סוג תנועה",
+    "תאריך חשבונית",
+    "פרטים",
+    "מזהה מובנה",
+    "סכום החשבונית",
+    "חוב לחשבונית",
+]
+
+MOVEMENT_TYPES = ["הת", "העב", "חסמ", "חש"]
+
+
+def make_aging_report(n_rows, n_columns=len(BASE_HEADERS), n_suppliers=None, seed=0):
+    """
+    מחזיר Workbook עם n_rows שורות נתונים ו-n_columns עמודות
+    (עמודות מעבר ל-BASE_HEADERS ממולאות בערכי סרק, כמו בייצוא רחב).
+    """
+    rnd = random.Random(seed)
+    n_suppliers = n_suppliers or max(1, n_rows // 10)
+    extra = max(0, n_columns - len(BASE_HEADERS))
+
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "DataSheet"
+    ws["C1"] = 'חברה לדוגמה בע"מ'
+    ws.append(BASE_HEADERS + [f"עמודה {i + 1}" for i in range(extra)])
+
+    for i in range(n_rows):
+        acc = str(1000 + rnd.randrange(n_suppliers))
+        amount = rnd.choice([1, -1]) * rnd.choice(
+            [100, 250, 409, 800, 801, 1490, rnd.randint(1, 50000)]
+        )
+        pay = datetime(2025, rnd.randint(1, 12), rnd.randint(1, 28))
+        row = [
+            'ש"ח',
+            acc,
+            f"ספק {acc}",
+            pay,
+            rnd.randint(0, 200),
+            f"BT{i:08d}",
+            None,
+            rnd.choice(MOVEMENT_TYPES),
+            pay,
+            None,
+            None,
+            0,
+            amount,
+        ]
+        row.extend(f"v{i}-{j}" for j in range(extra))
+        ws.append(row)
+    return wb
+
+
+def make_aging_report_bytes(n_rows, n_columns=len(BASE_HEADERS), n_suppliers=None, seed=0):
+    """כמו make_aging_report, אבל מחזיר את תוכן קובץ ה-xlsx כ-bytes."""
+    wb = make_aging_report(n_rows, n_columns=n_columns, n_suppliers=n_suppliers, seed=seed)
+    out = io.BytesIO()
+    wb.save(out)
+    return out.getvalue()
+
+
+def make_helper_bytes(n_suppliers, seed=0):
+    """קובץ עזר (חשבון / שם ספק / מייל) לספקים של make_aging_report, כ-bytes."""
+    rnd = random.Random(seed)
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(["חשבון", "שם ספק", "מייל"])
+    for i in range(n_suppliers):
+        # חלק מהספקים בלי מייל, כמו בקובץ אמיתי
+        if rnd.random() < 0.8:
+            acc = str(1000 + i)
+            ws.append([acc, f"ספק {acc}", f"supplier{acc}@example.com"])
+    out = io.BytesIO()
+    wb.save(out)
+    return out.getvalue()
@@ -1,6 +1,9 @@
 import io
+import json
+import threading
 import traceback
-from fastapi import FastAPI, File, UploadFile, HTTPException
+import uuid
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException
 from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -8,7 +11,15 @@ from openpyxl import load_workbook
 
 # ⚠️ חשוב: בקובץ הזה ברֶפּו צריך להיות streamlit_app.py
 # שבו מוגדרות הפונקציות build_email_mapping ו-process_workbook
-from streamlit_app import build_email_mapping, process_workbook
+from streamlit_app import (
+    OUTPUT_MODES,
+    OUTPUT_PATCH,
+    ProcessCancelled,
+    Progress,
+    build_email_mapping,
+    compile_rules,
+    process_file,
+)
 
 app = FastAPI(title="giulhovot-n8n-service")
 
@@ -22,6 +33,28 @@ app.add_middleware(
 )
 
 
+def parse_rules(rules_json):
+    """
+    כללי התאמה אופציונליים מה-request (JSON של רשימת כללים, ראו DEFAULT_RULES).
+    מחזיר MatchPlan מקומפל, או None לברירת המחדל.
+    """
+    if not rules_json:
+        return None
+    try:
+        return compile_rules(json.loads(rules_json))
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"כללי התאמה (rules) לא תקינים: {e}")
+
+
+def check_output_mode(output_mode):
+    if output_mode not in OUTPUT_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"output_mode חייב להיות אחד מ: {', '.join(OUTPUT_MODES)}",
+        )
+    return output_mode
+
+
 @app.get("/")
 async def root():
     """
@@ -42,20 +75,28 @@ async def health():
 async def process_files(
     file1: UploadFile = File(..., description="קובץ גיול חובות"),
     file2: UploadFile = File(..., description="קובץ מיילים של ספקים"),
+    rules: str = Form(None, description="JSON אופציונלי של כללי התאמה"),
+    output_mode: str = Form(OUTPUT_PATCH, description="patch (ברירת מחדל) או openpyxl"),
 ):
     """
     נקודת קצה ל-n8n:
 
     - file1 = גיול חובות (כמו ב-Streamlit)
     - file2 = קובץ אקסל עזר עם מיילים של ספקים
+    - rules = (אופציונלי) JSON של כללי התאמה במקום לוגיקות 1–6 הרגילות
+    - output_mode = patch – רק הצבעים והגיליונות החדשים נכתבים על הקובץ המקורי;
+      openpyxl – טעינה ושמירה מלאה (כמו פעם)
 
     הקוד:
-    1. טוען את file1 ל-Workbook.
+    1. טוען את file1 (read_only).
     2. בונה מיפוי מיילים מתוך file2 (build_email_mapping).
-    3. מריץ על ה-Workbook את כל הלוגיקות 1–7 (process_workbook).
+    3. מריץ את כל הלוגיקות 1–7 (process_file).
     4. מחזיר קובץ אקסל מעובד חזרה ל-n8n.
     """
     try:
+        plan = parse_rules(rules)
+        check_output_mode(output_mode)
+
         # --- קריאת הקבצים מה-request ---
         file1_bytes = await file1.read()
         file2_bytes = await file2.read()
@@ -67,7 +108,7 @@ async def process_files(
 
         # --- טעינת Workbook של גיול חובות (file1) ---
         try:
-            wb = load_workbook(io.BytesIO(file1_bytes), data_only=False)
+            wb = load_workbook(io.BytesIO(file1_bytes), read_only=True)
         except Exception as e:
             raise HTTPException(
                 status_code=400,
@@ -84,9 +125,15 @@ async def process_files(
                 detail=f"שגיאה בקריאת קובץ המיילים (file2): {e}",
             )
 
-        # --- הפעלת כל הלוגיקות 1–7 על ה-Workbook ---
+        # --- הפעלת כל הלוגיקות 1–7 וכתיבת הקובץ המעובד ---
         try:
-            wb = process_workbook(wb, email_mapping=email_mapping)
+            result_bytes = process_file(
+                file1_bytes,
+                email_mapping=email_mapping,
+                rules=plan,
+                output_mode=output_mode,
+                source_wb=wb,
+            )
         except HTTPException:
             # אם כבר הרמנו HTTPException בפנים – נעביר as-is
             raise
@@ -98,10 +145,7 @@ async def process_files(
                 detail=f"שגיאה בהרצת הלוגיקות על הקובץ: {e}",
             )
 
-        # --- שמירת ה-Workbook לקובץ בזיכרון ---
-        output = io.BytesIO()
-        wb.save(output)
-        output.seek(0)
+        output = io.BytesIO(result_bytes)
 
         # שם קובץ נחמד להורדה
         result_filename = "giulhovot_result.xlsx"
@@ -124,3 +168,141 @@ async def process_files(
             status_code=500,
             content={"detail": f"Internal server error: {str(e)}"},
         )
+
+
+# ---------- ג'ובים אסינכרוניים עם התקדמות וביטול ----------
+
+# כמה ג'ובים גמורים נשמרים בזיכרון (כולל הקובץ המעובד) לפני שהישנים נמחקים
+MAX_FINISHED_JOBS = 20
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+class Job:
+    """ריצה אחת של process_workbook ב-thread נפרד."""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = "queued"  # queued / running / done / failed / cancelled
+        self.progress = Progress()
+        self.result = None
+        self.error = None
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed", "cancelled")
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "progress": self.progress.snapshot(),
+        }
+
+
+jobs = {}
+jobs_lock = threading.Lock()
+
+
+def _register_job(job):
+    with jobs_lock:
+        finished = [j for j in jobs.values() if j.finished]
+        for old in finished[: max(0, len(finished) - MAX_FINISHED_JOBS + 1)]:
+            del jobs[old.id]
+        jobs[job.id] = job
+
+
+def _get_job(job_id):
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"ג'וב {job_id} לא נמצא.")
+    return job
+
+
+def _run_job(job, file1_bytes, file2_bytes, plan=None, output_mode=OUTPUT_PATCH):
+    job.status = "running"
+    try:
+        job.progress.start_stage("טעינת קבצים", 0)
+        email_mapping = build_email_mapping(io.BytesIO(file2_bytes))
+
+        job.result = process_file(
+            file1_bytes,
+            email_mapping=email_mapping,
+            progress=job.progress,
+            rules=plan,
+            output_mode=output_mode,
+        )
+        job.status = "done"
+    except ProcessCancelled:
+        job.status = "cancelled"
+    except Exception as e:
+        traceback.print_exc()
+        job.error = str(e)
+        job.status = "failed"
+
+
+@app.post("/jobs", status_code=202)
+async def start_job(
+    file1: UploadFile = File(..., description="קובץ גיול חובות"),
+    file2: UploadFile = File(..., description="קובץ מיילים של ספקים"),
+    rules: str = Form(None, description="JSON אופציונלי של כללי התאמה"),
+    output_mode: str = Form(OUTPUT_PATCH, description="patch (ברירת מחדל) או openpyxl"),
+):
+    """
+    כמו /process, אבל מחזיר מיד job_id.
+    מעקב: GET /jobs/{job_id}, ביטול: DELETE /jobs/{job_id},
+    הורדת התוצאה: GET /jobs/{job_id}/result.
+    """
+    plan = parse_rules(rules)
+    check_output_mode(output_mode)
+    file1_bytes = await file1.read()
+    file2_bytes = await file2.read()
+
+    if not file1_bytes:
+        raise HTTPException(status_code=400, detail="קובץ גיול חובות (file1) ריק או לא נקלט.")
+    if not file2_bytes:
+        raise HTTPException(status_code=400, detail="קובץ מיילים (file2) ריק או לא נקלט.")
+
+    job = Job()
+    _register_job(job)
+    threading.Thread(
+        target=_run_job,
+        args=(job, file1_bytes, file2_bytes, plan, output_mode),
+        daemon=True,
+    ).start()
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """סטטוס + התקדמות: שלב, שורות שעובדו, שורות מסומנות, ETA לשלב."""
+    return _get_job(job_id).to_dict()
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """
+    מבקש ביטול. הלולאות בודקות את הבקשה כל רבע שנייה לכל היותר,
+    כך שה-CPU משתחרר כמעט מיד; הסטטוס יהפוך ל-cancelled.
+    """
+    job = _get_job(job_id)
+    if not job.finished:
+        job.progress.cancel()
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = _get_job(job_id)
+    if job.status != "done":
+        raise HTTPException(
+            status_code=409,
+            detail=f"הג'וב עדיין לא הסתיים בהצלחה (status={job.status}).",
+        )
+    return StreamingResponse(
+        io.BytesIO(job.result),
+        media_type=XLSX_MEDIA_TYPE,
+        headers={"Content-Disposition": 'attachment; filename="giulhovot_result.xlsx"'},
+    )
@@ -1,12 +1,23 @@
+import csv
+import hashlib
 import io
+import json
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
-from datetime import datetime
+from datetime import date, datetime
+from itertools import groupby
 
 import openpyxl
 from openpyxl.styles import PatternFill, Alignment
 import streamlit as st
 import requests
 
+from audit_log import AUDIT_SHEET_TITLE, PairLog, read_audit_rows
+from xlsx_patch import XlsxPatchError, patch_xlsx
+
 
 # ========= הגדרות N8N =========
 # להחליף ל-Webhook האמיתי שלך
@@ -73,25 +84,107 @@ PURPLE_FILL = PatternFill(start_color=PURPLE_RGB, end_color=PURPLE_RGB, fill_typ
 BLUE_FILL = PatternFill(start_color=BLUE_RGB, end_color=BLUE_RGB, fill_type="solid")
 
 
-def cell_rgb(cell):
+# ---------- סטטוס צבע (מטמון מילויים) ----------
+
+# סטטוס צבע של תא סכום – ערך בית אחד ב-bytearray
+COLOR_NONE = 0      # בלי מילוי
+COLOR_GREEN = 1
+COLOR_ORANGE = 2
+COLOR_PURPLE = 3
+COLOR_BLUE = 4
+COLOR_FOREIGN = 5   # מילוי solid בצבע שלא שייך ללוגיקות
+
+STATUS_BY_RGB = {
+    GREEN_RGB: COLOR_GREEN,
+    ORANGE_RGB: COLOR_ORANGE,
+    PURPLE_RGB: COLOR_PURPLE,
+    BLUE_RGB: COLOR_BLUE,
+}
+
+FILL_BY_STATUS = {
+    COLOR_GREEN: GREEN_FILL,
+    COLOR_ORANGE: ORANGE_FILL,
+    COLOR_PURPLE: PURPLE_FILL,
+    COLOR_BLUE: BLUE_FILL,
+}
+
+RGB_BY_STATUS = {code: rgb for rgb, code in STATUS_BY_RGB.items()}
+
+
+def fill_status(fill):
+    """ממפה אובייקט מילוי של openpyxl לסטטוס צבע."""
+    if fill.fill_type != "solid":
+        return COLOR_NONE
     try:
-        return cell.fill.start_color.rgb
+        rgb = fill.start_color.rgb
     except Exception:
-        return None
+        rgb = None
+    return STATUS_BY_RGB.get(rgb, COLOR_FOREIGN)
 
 
-def has_any_color(cell):
-    """בודק אם לתא יש אחד מהצבעים של הלוגיקות."""
-    return cell.fill.fill_type == "solid" and cell_rgb(cell) in {
-        GREEN_RGB,
-        ORANGE_RGB,
-        PURPLE_RGB,
-        BLUE_RGB,
-    }
+class FillStatus:
+    """
+    סטטוס הצבע של עמודת הסכום לכל שורת נתונים, ב-bytearray.
+
+    המילוי של כל תא נפתר פעם אחת בטעינה (from_fill_ids), עם מטמון לפי fillId
+    של openpyxl, כך שכל סגנון מפוענח פעם אחת בלבד. בזמן ההתאמה הבדיקה
+    והצביעה הן קריאה/כתיבה ל-bytearray בלבד; התאים עצמם נצבעים ב-apply.
+    צבעים שכבר קיימים בקובץ שהועלה מחדש נשמרים ומכובדים.
+    """
+
+    def __init__(self, status, base):
+        self.status = status  # bytearray, אינדקס = שורה - base
+        self.base = base      # השורה הראשונה של הנתונים
+
+    @classmethod
+    def from_fill_ids(cls, fill_ids, fills, data_start_row):
+        """fill_ids – fillId של תא הסכום לכל רשומה; fills – wb._fills."""
+        status = bytearray(len(fill_ids))
+        by_fill_id = {}
+        for i, fill_id in enumerate(fill_ids):
+            code = by_fill_id.get(fill_id)
+            if code is None:
+                code = by_fill_id[fill_id] = fill_status(fills[fill_id])
+            status[i] = code
+        return cls(status, data_start_row)
+
+    def copy(self):
+        return FillStatus(bytearray(self.status), self.base)
+
+    def is_colored(self, rec):
+        """האם התא כבר צבוע באחד מצבעי הלוגיקות."""
+        return COLOR_NONE < self.status[rec.row - self.base] < COLOR_FOREIGN
+
+    def paint(self, rec, code):
+        self.status[rec.row - self.base] = code
+
+    def changes(self, initial):
+        """זוגות (שורה, סטטוס) שהשתנו לעומת initial."""
+        base = self.base
+        return [
+            (i + base, code)
+            for i, (code, before) in enumerate(zip(self.status, initial.status))
+            if code != before
+        ]
+
+    def apply(self, ws, col_amt, initial):
+        """צובע בגיליון רק את התאים שהסטטוס שלהם השתנה לעומת initial."""
+        for row, code in self.changes(initial):
+            ws.cell(row=row, column=col_amt).fill = FILL_BY_STATUS[code]
 
 
 # ---------- גיליון סיכום ----------
 
+def summary_sheet_rows(counts):
+    """שורות גיליון סיכום (כולל כותרת) מתוך {חשבון -> כמות}."""
+    rows = [["מס ספק", "כמות שורות מותאמות"]]
+    for acc, cnt in counts.items():
+        if acc is None or cnt <= 0:
+            continue
+        rows.append([acc, cnt])
+    return rows
+
+
 def ensure_summary_sheet(wb, title, counts):
     """יצירה/ניקוי גיליון סיכום והזנת נתונים."""
     if title in wb.sheetnames:
@@ -102,23 +195,192 @@ def ensure_summary_sheet(wb, title, counts):
     else:
         ws_sum = wb.create_sheet(title)
 
-    ws_sum["A1"] = "מס ספק"
-    ws_sum["B1"] = "כמות שורות מותאמות"
-
-    r = 2
-    for acc, cnt in counts.items():
-        if acc is None or cnt <= 0:
-            continue
-        ws_sum.cell(r, 1, acc)
-        ws_sum.cell(r, 2, cnt)
-        r += 1
+    for r, values in enumerate(summary_sheet_rows(counts), start=1):
+        for c, value in enumerate(values, start=1):
+            ws_sum.cell(r, c, value)
 
 
 # ---------- קריאת אקסל עזר (מיילים) ----------
 
+# נרמול שם ספק: גרשיים ומירכאות נמחקים ('בע"מ' -> 'בעמ'), פיסוק הופך לרווח
+_NAME_TRANSLATE = str.maketrans(
+    {**{ch: None for ch in "\"'`׳״“”‘’"}, **{ch: " " for ch in ".,-_()/\\"}}
+)
+
+# סיומות של צורת התאגדות – אחרי מחיקת גרשיים ('בע"מ' -> 'בעמ')
+_NAME_SUFFIXES = {"בעמ", "ער", "עמ", "ltd", "inc"}
+
+MATCH_ACCOUNT = "חשבון"
+MATCH_NAME = "שם ספק"
+MATCH_NORMALIZED = "שם מנורמל"
+MATCH_FUZZY = "דמיון"
+
+FUZZY_MIN_SCORE = 0.8
+
+
+def normalize_account(val):
+    """חשבון כמחרוזת: 6341.0, '6341.0' ו-' 6341 ' כולם הופכים ל-'6341'."""
+    if val is None:
+        return ""
+    if isinstance(val, float) and val.is_integer():
+        val = int(val)
+    text = str(val).strip()
+    head, dot, tail = text.partition(".")
+    if dot and head.isdigit() and tail and not tail.strip("0"):
+        return head
+    return text
+
+
+def normalize_supplier_name(val):
+    """
+    מפתח מנורמל לשם ספק: בלי גרשיים/פיסוק, רווחים כפולים
+    וסיומות כמו 'בע"מ' / 'ע"ר', באותיות קטנות.
+    """
+    if val is None:
+        return ""
+    tokens = str(val).translate(_NAME_TRANSLATE).lower().split()
+    while len(tokens) > 1 and tokens[-1] in _NAME_SUFFIXES:
+        tokens.pop()
+    return " ".join(tokens)
+
+
+def _name_ngrams(norm, n=3):
+    padded = f" {norm} "
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+def _name_numbers(norm):
+    """הטוקנים עם ספרות בשם מנורמל ('סניף 12' -> ('12',))."""
+    return tuple(t for t in norm.split() if any(ch.isdigit() for ch in t))
+
+
+class EmailIndex(dict):
+    """
+    מיפוי {חשבון/שם ספק -> מייל}.
+
+    כמילון הוא מתנהג בדיוק כמו המיפוי הישן (מפתחות אחרי strip),
+    ובנוסף מחזיק אינדקס לפי מפתחות מנורמלים ואינדקס טריגרמים של
+    שמות לצורך התאמה חלקית – בלי השוואת מרחק עריכה מול כל ספק.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.by_account = {}   # חשבון מנורמל -> מייל
+        self.has_accounts = False  # בקובץ העזר יש עמודת חשבון (build_email_mapping)
+        self._name_ids = {}    # שם מנורמל -> id
+        self._emails = []      # מייל לפי id
+        self._numbers = []     # _name_numbers לפי id
+        self._gram_counts = []
+        self._grams = defaultdict(list)  # טריגרם -> ids של שמות
+
+    @classmethod
+    def from_mapping(cls, mapping):
+        """עטיפה למילון רגיל – כל מפתח נחשב גם חשבון וגם שם."""
+        index = cls()
+        for key, email in mapping.items():
+            index.add(account=key, name=key, email=email)
+        return index
+
+    def add(self, account=None, name=None, email=None):
+        if not email:
+            return
+        email = str(email).strip()
+
+        if account:
+            self[str(account).strip()] = email
+            acc_key = normalize_account(account)
+            if acc_key:
+                self.by_account[acc_key] = email
+
+        if name:
+            self[str(name).strip()] = email
+            norm = normalize_supplier_name(name)
+            name_id = self._name_ids.get(norm) if norm else None
+            if name_id is not None:
+                self._emails[name_id] = email
+            elif norm:
+                grams = _name_ngrams(norm)
+                name_id = self._name_ids[norm] = len(self._emails)
+                self._emails.append(email)
+                self._numbers.append(_name_numbers(norm))
+                self._gram_counts.append(len(grams))
+                for g in grams:
+                    self._grams[g].append(name_id)
+
+    def lookup(self, account=None, name=None):
+        """
+        מחזיר (מייל, סוג התאמה). סדר העדיפויות:
+        חשבון מדויק -> שם מדויק -> חשבון/שם מנורמל -> דמיון טריגרמים.
+        המייל הולך להודעת "חסרות חשבוניות", ולכן דמיון לא נבדק כשלספק יש
+        חשבון ובקובץ העזר יש עמודת חשבון בלי החשבון הזה – עדיף בלי מייל
+        מאשר מייל של ספק אחר.
+        """
+        if account is not None:
+            email = self.get(str(account).strip())
+            if email:
+                return email, MATCH_ACCOUNT
+        if name:
+            email = self.get(str(name).strip())
+            if email:
+                return email, MATCH_NAME
+
+        acc_key = normalize_account(account)
+        if acc_key:
+            email = self.by_account.get(acc_key)
+            if email:
+                return email, MATCH_ACCOUNT
+
+        norm = normalize_supplier_name(name) if name else ""
+        if not norm:
+            return "", ""
+        name_id = self._name_ids.get(norm)
+        if name_id is not None:
+            return self._emails[name_id], MATCH_NORMALIZED
+
+        if self.has_accounts and acc_key:
+            return "", ""
+        name_id, score = self._fuzzy(norm)
+        if name_id is not None:
+            return self._emails[name_id], f"{MATCH_FUZZY} {score:.0%}"
+        return "", ""
+
+    def _fuzzy(self, norm):
+        """
+        המועמד הטוב ביותר לפי מקדם Dice על טריגרמים, רק אם הוא חד-משמעי.
+        מספרים בשם חייבים להיות זהים: 'סניף 12' ו-'סניף 13' הם ספקים שונים
+        גם כשכל השאר זהה.
+        """
+        grams = _name_ngrams(norm)
+        numbers = _name_numbers(norm)
+        # טריגרמים נפוצים מדי (למשל 'בע ') לא מבחינים בין ספקים ורק מאטים
+        max_posting = max(100, len(self._emails) // 20)
+
+        shared = defaultdict(int)
+        for g in grams:
+            posting = self._grams.get(g)
+            if posting is None or len(posting) > max_posting:
+                continue
+            for name_id in posting:
+                shared[name_id] += 1
+
+        best_id, best_score, tie = None, 0.0, False
+        for name_id, cnt in shared.items():
+            if self._numbers[name_id] != numbers:
+                continue
+            score = 2.0 * cnt / (len(grams) + self._gram_counts[name_id])
+            if score > best_score:
+                best_id, best_score, tie = name_id, score, False
+            elif score == best_score and self._emails[name_id] != self._emails[best_id]:
+                tie = True
+
+        if best_id is None or tie or best_score < FUZZY_MIN_SCORE:
+            return None, 0.0
+        return best_id, best_score
+
+
 def build_email_mapping(helper_file):
     """
-    בונה מילון {חשבון/שם ספק -> מייל} מקובץ עזר.
+    בונה EmailIndex {חשבון/שם ספק -> מייל} מקובץ עזר, במעבר אחד על הגיליון.
     מחפש עמודות:
     - 'חשבון' / 'מס ספק'
     - 'שם ספק' / 'תאור חשבון' / 'תיאור חשבון'
@@ -138,38 +400,557 @@ def build_email_mapping(helper_file):
         or headers.get("E-mail")
     )
 
-    email_map = {}
+    index = EmailIndex()
 
     if col_email is None:
-        return email_map
+        return index
+    index.has_accounts = col_acc is not None
+
+    # שמות דורסים חשבונות עם אותו מפתח (כמו בסדר הישן: קודם חשבון ואז שם)
+    by_acc, by_name = [], []
+    for values in ws_help.iter_rows(min_row=header_row + 1, values_only=True):
+        email = values[col_email - 1]
+        if not email:
+            continue
+        if col_acc is not None and values[col_acc - 1]:
+            by_acc.append((values[col_acc - 1], email))
+        if col_name is not None and values[col_name - 1]:
+            by_name.append((values[col_name - 1], email))
+
+    for acc, email in by_acc:
+        index.add(account=acc, email=email)
+    for name, email in by_name:
+        index.add(name=name, email=email)
+
+    return index
+
+
+# ---------- התקדמות וביטול ----------
+
+class ProcessCancelled(Exception):
+    """הריצה בוטלה דרך Progress.cancel()."""
 
-    # לפי חשבון
-    if col_acc is not None:
-        for row in ws_help.iter_rows(min_row=header_row + 1):
-            acc = row[col_acc - 1].value
-            email = row[col_email - 1].value
-            if acc and email:
-                email_map[str(acc).strip()] = str(email).strip()
 
-    # לפי שם ספק
-    if col_name is not None:
-        for row in ws_help.iter_rows(min_row=header_row + 1):
-            name = row[col_name - 1].value
-            email = row[col_email - 1].value
-            if name and email:
-                email_map[str(name).strip()] = str(email).strip()
+class Progress:
+    """
+    מעקב התקדמות וביטול לריצה של process_workbook.
+
+    הלולאות קוראות ל-tick() – ספירה ובדיקת שעון בלבד. לכל היותר פעם
+    ב-interval שניות נקרא callback(progress) ונבדק אם התבקש ביטול;
+    אם כן – נזרק ProcessCancelled מתוך הלולאה.
+    cancel() בטוח לקריאה מ-thread אחר (למשל מה-API).
+    """
+
+    def __init__(self, callback=None, interval=0.25):
+        self.callback = callback
+        self.interval = interval
+        self.stage = ""
+        self.total = 0      # שורות/פריטים בשלב הנוכחי
+        self.done = 0
+        self.matches = 0    # שורות שסומנו עד עכשיו (כל הלוגיקות)
+        self._cancel = threading.Event()
+        self._stage_started = time.monotonic()
+        self._next_report = self._stage_started
+
+    def start_stage(self, stage, total):
+        self.stage = stage
+        self.total = total
+        self.done = 0
+        self._stage_started = time.monotonic()
+        self._report(self._stage_started)
+
+    def tick(self, n=1):
+        self.done += n
+        now = time.monotonic()
+        if now >= self._next_report:
+            self._report(now)
+
+    @property
+    def eta(self):
+        """שניות משוערות עד סוף השלב הנוכחי (None כשאין עדיין על מה להעריך)."""
+        if not self.done or not self.total:
+            return None
+        elapsed = time.monotonic() - self._stage_started
+        return elapsed / self.done * max(0, self.total - self.done)
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def snapshot(self):
+        """מצב נוכחי כ-dict (ל-JSON של סטטוס ג'וב)."""
+        eta = self.eta
+        return {
+            "stage": self.stage,
+            "done": self.done,
+            "total": self.total,
+            "matches": self.matches,
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+        }
+
+    def _report(self, now):
+        self._next_report = now + self.interval
+        if self._cancel.is_set():
+            raise ProcessCancelled(f"הריצה בוטלה בשלב '{self.stage}'.")
+        if self.callback is not None:
+            self.callback(self)
+
+
+# ---------- רשומות שורה קומפקטיות ----------
+
+class LedgerRow:
+    """
+    רשומה קומפקטית לשורה בגיול – רק מה שהלוגיקות צריכות.
+    לא מחזיקים את ה-tuple של כל תאי השורה; התא של הסכום נשלף
+    לפי קואורדינטה (row, col_amt) רק כשבאמת צובעים אותו.
+    """
+
+    __slots__ = ("row", "amount", "acc", "mtype", "name", "pay", "debt")
+
+    def __init__(self, row, amount, acc, mtype, name, pay, debt):
+        self.row = row        # מספר השורה בגיליון
+        self.amount = amount  # סכום אחרי parse_amount (None אם לא מספר)
+        self.acc = acc        # חשבון – ערך גולמי, משמש כמפתח קיבוץ
+        self.mtype = mtype    # סוג תנועה אחרי strip
+        self.name = name      # שם ספק
+        self.pay = pay        # תאריך תשלום
+        self.debt = debt      # חוב לחשבונית – ערך גולמי למייל
+
+
+def load_ledger_rows(
+    ws, data_start_row, col_acc, col_amt, col_type, col_name, col_pay, progress=None
+):
+    """
+    מעבר יחיד על הגיליון שמחזיר (רשימת LedgerRow, fillId של תא הסכום לכל רשומה).
+    עובד גם על גיליון read_only – בלי גישה אקראית לתאים.
+    """
+    i_acc = col_acc - 1
+    i_amt = col_amt - 1
+    i_type = col_type - 1 if col_type is not None else None
+    i_name = col_name - 1
+    i_pay = col_pay - 1
+    width = max(i for i in (i_acc, i_amt, i_type, i_name, i_pay) if i is not None) + 1
+
+    if progress is None:
+        progress = Progress()
+
+    records = []
+    fill_ids = array("I")
+    for row_idx, cells in enumerate(
+        ws.iter_rows(min_row=data_start_row, max_col=width),
+        start=data_start_row,
+    ):
+        values = [c.value for c in cells]
+        values.extend([None] * (width - len(values)))
+
+        amt_cell = cells[i_amt] if i_amt < len(cells) else None
+        # Cell רגיל מחזיק _style, ReadOnlyCell מחזיר style_array, ל-EmptyCell אין סגנון
+        style = getattr(amt_cell, "_style", None) or getattr(amt_cell, "style_array", None)
+        fill_ids.append(style.fillId if style is not None else 0)
+
+        debt = values[i_amt]
+        try:
+            amount = parse_amount(debt)
+        except Exception:
+            amount = None
+
+        mtype = ""
+        if i_type is not None:
+            tval = values[i_type]
+            mtype = str(tval).strip() if tval is not None else ""
+
+        records.append(
+            LedgerRow(
+                row_idx,
+                amount,
+                values[i_acc],
+                mtype,
+                values[i_name],
+                values[i_pay],
+                debt,
+            )
+        )
+        if progress.done >= progress.total:
+            progress.total = progress.done + 1  # הגודל מ-<dimension> היה קטן מדי
+        progress.tick()
+    return records, fill_ids
+
+
+# ---------- כללי התאמה ----------
+
+SCOPE_SUPPLIER = "supplier"    # זוגות +/- בתוך אותו חשבון
+SCOPE_GLOBAL = "global"        # זוגות +/- בין כל החשבונות
+SCOPE_MOVEMENT = "movement"    # כל שורה עם סוג תנועה מסוים
+
+STATUS_BY_COLOR_NAME = {
+    "green": COLOR_GREEN,
+    "orange": COLOR_ORANGE,
+    "purple": COLOR_PURPLE,
+    "blue": COLOR_BLUE,
+}
+
+# סובלנות 0 = התאמה מדויקת (עד שגיאת עיגול של float)
+EXACT_EPSILON = 1e-6
+
+# הלוגיקות 1–6 המקוריות, לפי הסדר
+DEFAULT_RULES = [
+    {
+        "name": "התאמה 100%",
+        "scope": SCOPE_SUPPLIER,
+        "tolerance": 0,
+        "color": "green",
+        "summary": "התאמה 100%",
+        # לוגיקה 1 מתאימה גם שורות שכבר צבועות בקובץ
+        "respect_colors": False,
+    },
+    {
+        "name": "התאמה 80%",
+        "scope": SCOPE_SUPPLIER,
+        "tolerance": 2,
+        "color": "orange",
+        "summary": "התאמה 80%",
+    },
+    {
+        "name": "בדיקת ספקים",
+        "scope": SCOPE_GLOBAL,
+        "tolerance": 2,
+        "color": "purple",
+        "summary": "בדיקת ספקים",
+    },
+    {
+        "name": "העב",
+        "scope": SCOPE_MOVEMENT,
+        "movement_type": "העב",
+        "color": "blue",
+        "mail": True,
+    },
+]
+
+
+class MatchRule:
+    """כלל התאמה אחד אחרי ולידציה (ראו DEFAULT_RULES לשדות)."""
+
+    def __init__(self, spec):
+        if not isinstance(spec, dict):
+            raise ValueError(f"כלל התאמה חייב להיות מילון, התקבל: {spec!r}")
+
+        self.scope = spec.get("scope")
+        if self.scope not in (SCOPE_SUPPLIER, SCOPE_GLOBAL, SCOPE_MOVEMENT):
+            raise ValueError(f"scope לא מוכר בכלל התאמה: {self.scope!r}")
+
+        color = spec.get("color")
+        if color not in STATUS_BY_COLOR_NAME:
+            raise ValueError(
+                f"צבע לא מוכר בכלל התאמה: {color!r} "
+                f"(אפשרויות: {', '.join(STATUS_BY_COLOR_NAME)})"
+            )
+        self.color = STATUS_BY_COLOR_NAME[color]
+
+        self.tolerance = float(spec.get("tolerance", 0))
+        if self.tolerance < 0:
+            raise ValueError("tolerance בכלל התאמה לא יכול להיות שלילי.")
+
+        self.movement_type = str(spec.get("movement_type") or "").strip()
+        if self.scope == SCOPE_MOVEMENT and not self.movement_type:
+            raise ValueError("כלל עם scope='movement' חייב movement_type.")
+
+        self.name = spec.get("name") or spec.get("summary") or color
+        self.summary = spec.get("summary")
+        self.order = spec.get("order", 0)
+        self.respect_colors = bool(spec.get("respect_colors", True))
+        self.mail = bool(spec.get("mail", False))
+
+    def within(self, diff):
+        """האם p + n בטווח הסובלנות."""
+        if self.tolerance == 0:
+            return abs(diff) < EXACT_EPSILON
+        return abs(diff) <= self.tolerance
+
+
+class MatchPlan:
+    """
+    תוכנית הרצה מקומפלת: הכללים לפי הסדר, ואילו אינדקסים צריך לבנות.
+    כל האינדקסים נבנים פעם אחת מהרשומות ומשותפים לכל הכללים באותו scope.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.scopes = {rule.scope for rule in rules}
+
+
+def compile_rules(rules=None):
+    """
+    מקמפל רשימת כללים (dicts, למשל מ-JSON) ל-MatchPlan.
+    None – DEFAULT_RULES. MatchPlan קיים מוחזר כמו שהוא.
+    הסדר: לפי 'order' ואז לפי המיקום ברשימה.
+    """
+    if isinstance(rules, MatchPlan):
+        return rules
+    if rules is None:
+        rules = DEFAULT_RULES
+    compiled = [MatchRule(spec) for spec in rules]
+    _check_summary_titles(compiled)
+    compiled = [
+        rule for _, rule in sorted(enumerate(compiled), key=lambda x: (x[1].order, x[0]))
+    ]
+    return MatchPlan(compiled)
+
+
+# מגבלות של Excel על שמות גיליונות
+MAX_SHEET_TITLE = 31
+INVALID_SHEET_TITLE_CHARS = set("[]:*?/\\")
+
+
+def _check_summary_titles(rules):
+    """
+    שמות גיליונות הסיכום של הכללים: שם חוקי ב-Excel, בלי כפילויות
+    (Excel לא מבחין בין אותיות גדולות וקטנות) ובלי לדרוס גיליון שהקוד עצמו כותב.
+    """
+    reserved = {t.casefold() for t in (AGING_SHEET_TITLE, MAIL_SHEET_TITLE, AUDIT_SHEET_TITLE)}
+    seen = set()
+    for rule in rules:
+        title = rule.summary
+        if not title:
+            continue
+        if not isinstance(title, str):
+            raise ValueError(f"summary בכלל '{rule.name}' חייב להיות מחרוזת, התקבל: {title!r}")
+        if len(title) > MAX_SHEET_TITLE:
+            raise ValueError(
+                f"summary '{title}' ארוך מדי (מקסימום {MAX_SHEET_TITLE} תווים בשם גיליון)."
+            )
+        bad = INVALID_SHEET_TITLE_CHARS.intersection(title)
+        if bad:
+            raise ValueError(
+                f"summary '{title}' מכיל תווים אסורים בשם גיליון: {' '.join(sorted(bad))}"
+            )
+        key = title.casefold()
+        if key in reserved:
+            raise ValueError(f"summary '{title}' שמור לגיליון שהמערכת כותבת.")
+        if key in seen:
+            raise ValueError(f"summary '{title}' מופיע ביותר מכלל אחד.")
+        seen.add(key)
+
+
+class _SignedIndex:
+    """
+    קבוצת רשומות (חשבון אחד או הכל): חיוביים לפי סדר השורות,
+    ושליליים ממוינים לפי (סכום, שורה) – מיון אחד לכל הכללים.
+    """
+
+    def __init__(self, recs):
+        self.pos = [rec for rec in recs if rec.amount is not None and rec.amount > 0]
+        self.neg = sorted(
+            (rec for rec in recs if rec.amount is not None and rec.amount < 0),
+            key=lambda rec: (rec.amount, rec.row),
+        )
+
+
+def _match_pairs(index, rule, stage, colors, counts, pairs, progress):
+    """
+    זוגות +/- לכלל אחד בתוך index, באותה סמנטיקה חמדנית של הלוגיקות המקוריות:
+    כל חיובי (לפי סדר השורות) נצמד לשלילי הפנוי הראשון בסדר השורות שבטווח.
+    החיפוש הוא bisect על השליליים הממוינים, במקום מעבר על כולם.
+    כל זוג נרשם ב-pairs (PairLog) תחת stage.
+    """
+    is_colored = colors.is_colored
+    paint = colors.paint
+    record = pairs.entries.append
+    tick = progress.tick
+    respect = rule.respect_colors
+    within = rule.within
+    window = rule.tolerance + EXACT_EPSILON
+
+    cands = [rec for rec in index.neg if not (respect and is_colored(rec))]
+    keys = [rec.amount for rec in cands]
+
+    matched = 0
+    for prec in index.pos:
+        tick()
+        if respect and is_colored(prec):
+            continue
+
+        target = -prec.amount
+        j = bisect_left(keys, target - window)
+        hi = bisect_right(keys, target + window)
+        best = None
+        while j < hi:
+            # בתוך רצף של אותו סכום השורות ממוינות – מספיק לבדוק את הראשונה
+            if within(prec.amount + keys[j]) and (best is None or cands[j].row < cands[best].row):
+                best = j
+            j = bisect_right(keys, keys[j], j, hi)
+
+        if best is None:
+            continue
+        nrec = cands.pop(best)
+        del keys[best]
+
+        paint(prec, rule.color)
+        paint(nrec, rule.color)
+        record((stage, prec, nrec))
+        counts[prec.acc] += 1
+        counts[nrec.acc] += 1
+        matched += 2
+
+    progress.matches += matched
+
+
+def _mark_movement(records, rule, stage, colors, counts, pairs, rows_mail, progress):
+    """צובע כל שורה מסוג התנועה של הכלל (ואוסף אותה למיילים אם צריך)."""
+    is_colored = colors.is_colored
+    paint = colors.paint
+    record = pairs.entries.append
+    tick = progress.tick
+    respect = rule.respect_colors
+    movement_type = rule.movement_type
+
+    for rec in records:
+        tick()
+        if rec.mtype != movement_type:
+            continue
+        if respect and is_colored(rec):
+            continue
+        paint(rec, rule.color)
+        record((stage, rec, None))
+        counts[rec.acc] += 1
+        progress.matches += 1
+        if rule.mail:
+            rows_mail.append(rec)
+
+
+# ---------- גיול פתוח לפי דליים ----------
+
+AGING_SHEET_TITLE = "גיול פתוח"
+# (כותרת, עד כמה ימים מתאריך התשלום); הדלי האחרון בלי גבול עליון
+AGING_BUCKETS = [("0–30", 30), ("31–60", 60), ("61–90", 90), ("90+", None)]
+AGING_NO_DATE = "ללא תאריך"
+_PAY_DATE_FORMATS = ("%d/%m/%Y", "%d/%m/%y", "%Y-%m-%d")
+
+
+def parse_pay_date(val):
+    """תאריך תשלום כ-date (datetime / date / מחרוזת dd/mm/yy), None אם אי אפשר."""
+    if isinstance(val, datetime):
+        return val.date()
+    if isinstance(val, date):
+        return val
+    if isinstance(val, str):
+        s = val.strip()
+        for fmt in _PAY_DATE_FORMATS:
+            try:
+                return datetime.strptime(s, fmt).date()
+            except ValueError:
+                continue
+    return None
+
+
+def _aging_slot(days):
+    """אינדקס הדלי לפי ימים מתאריך התשלום (תאריך עתידי נכנס לדלי הראשון)."""
+    for i, (_, limit) in enumerate(AGING_BUCKETS):
+        if limit is None or days <= limit:
+            return i
+
+
+class AgingSummary:
+    """
+    יתרות פתוחות לכל ספק לפי דליי גיול.
+    by_acc – {חשבון: [סכום לכל דלי ב-AGING_BUCKETS..., ללא תאריך]} לפי סדר הופעה.
+    """
+
+    def __init__(self, as_of):
+        self.as_of = as_of
+        self.by_acc = {}
+        self.names = {}
+
+    def add(self, acc, name, slot, amount):
+        sums = self.by_acc.get(acc)
+        if sums is None:
+            sums = self.by_acc[acc] = [0.0] * (len(AGING_BUCKETS) + 1)
+            self.names[acc] = name
+        sums[slot] += amount
+
+    def sheet_rows(self):
+        """שורות גיליון 'גיול פתוח' (כותרת, שורה לכל ספק, שורת סה"כ)."""
+        rows = [
+            ["מס ספק", "שם ספק"]
+            + [title for title, _ in AGING_BUCKETS]
+            + [AGING_NO_DATE, 'סה"כ פתוח']
+        ]
+        totals = [0.0] * (len(AGING_BUCKETS) + 1)
+        for acc, sums in self.by_acc.items():
+            rows.append([acc, self.names[acc]] + [round(v, 2) for v in sums] + [round(sum(sums), 2)])
+            for i, v in enumerate(sums):
+                totals[i] += v
+        rows.append(
+            ['סה"כ', f"נכון ל-{self.as_of.strftime('%d/%m/%y')}"]
+            + [round(v, 2) for v in totals]
+            + [round(sum(totals), 2)]
+        )
+        return rows
+
 
-    return email_map
+def aging_by_supplier(records, colors, matched_colors, as_of):
+    """
+    מעבר אחד על הרשומות: כל שורה שלא הותאמה (הצבע הסופי שלה לא שייך
+    לאף כלל זוגות) נכנסת ליתרה של הספק שלה לפי ימים מתאריך התשלום.
+    """
+    summary = AgingSummary(as_of)
+    as_of_ordinal = as_of.toordinal()
+    status = colors.status
+    base = colors.base
+    no_date = len(AGING_BUCKETS)
+
+    for rec in records:
+        if not rec.amount or status[rec.row - base] in matched_colors:
+            continue
+        pay = parse_pay_date(rec.pay)
+        slot = no_date if pay is None else _aging_slot(as_of_ordinal - pay.toordinal())
+        summary.add(rec.acc, rec.name, slot, rec.amount)
+    return summary
 
 
 # ---------- לוגיקות 1–7 ----------
 
-def process_workbook(wb, email_mapping=None):
+class Ledger:
     """
-    מריץ על ה-Workbook את כל הלוגיקות 1–7.
-    email_mapping – מילון אופציונלי {חשבון/שם ספק -> מייל}.
+    הגיול אחרי קריאה אחת של הגיליון: רשומות, סטטוס הצבעים ההתחלתי
+    ומה שצריך כדי לכתוב את התוצאות חזרה. לא מחזיק הפניה ל-Workbook,
+    ולכן אפשר לשמור אותו במטמון (pickle).
     """
-    ws = wb.active  # הגיליון הראשון הוא המקור
+
+    def __init__(self, records, colors, col_amt, data_start_row, company_name, audit_rows=()):
+        self.records = records
+        self.colors = colors              # FillStatus כפי שנטען מהקובץ
+        self.col_amt = col_amt
+        self.data_start_row = data_start_row
+        self.company_name = company_name
+        self.audit_rows = audit_rows      # יומן ההתאמות מריצה קודמת (העלאה חוזרת)
+
+
+class MatchResult:
+    """
+    תוצאת כללי ההתאמה: סטטוס צבעים סופי, [(שם גיליון סיכום, ספירות)]
+    לפי סדר הכללים, שורות 'העב' למיילים, יומן הזוגות (PairLog)
+    ויתרות פתוחות לפי דליי גיול (AgingSummary).
+    """
+
+    def __init__(self, colors, summaries, rows_mail, pairs, aging):
+        self.colors = colors
+        self.summaries = summaries
+        self.rows_mail = rows_mail
+        self.pairs = pairs
+        self.aging = aging
+
+
+def parse_ledger(ws, progress=None):
+    """מזהה כותרות וקורא את גיליון הגיול ל-Ledger (גם מגיליון read_only)."""
+    # ב-read_only openpyxl קורא רק עד הגודל שבתג <dimension>, וחלק מכלי הייצוא
+    # כותבים שם ערך שגוי. קוראים עד השורה האחרונה בפועל; הגודל מהתג משמש רק
+    # כהערכה ל-progress
+    n_rows = ws.max_row or 0
+    if hasattr(ws, "reset_dimensions"):
+        ws.reset_dimensions()
 
     header_row, headers = detect_headers(ws)
 
@@ -192,211 +973,432 @@ def process_workbook(wb, email_mapping=None):
     # שם החברה לכותרת מייל
     company_name = ws["C1"].value if ws["C1"].value is not None else ""
 
-    # ===== לוגיקה 1 – ירוק 100% בתוך ספק =====
-    groups = defaultdict(list)
-    for row in ws.iter_rows(min_row=data_start_row):
-        acc = row[col_acc - 1].value
-        groups[acc].append(row)
-
-    green_counts = defaultdict(int)
-
-    for acc, rows in groups.items():
-        pos, neg = [], []
-        for r in rows:
-            cell = r[col_amt - 1]
-            try:
-                v = parse_amount(cell.value)
-            except Exception:
-                continue
-            if v > 0:
-                pos.append((v, r))
-            elif v < 0:
-                neg.append((v, r))
-
-        used_neg = set()
-        for pval, prow in pos:
-            for ni, (nval, nrow) in enumerate(neg):
-                if ni in used_neg:
-                    continue
-                if abs(pval + nval) < 1e-6:
-                    prow[col_amt - 1].fill = GREEN_FILL
-                    nrow[col_amt - 1].fill = GREEN_FILL
-                    green_counts[acc] += 2
-                    used_neg.add(ni)
-                    break
-
-    ensure_summary_sheet(wb, "התאמה 100%", green_counts)
-
-    # ===== לוגיקה 3 – כתום 80% בתוך ספק =====
-    orange_counts = defaultdict(int)
-
-    for acc, rows in groups.items():
-        pos, neg = [], []
-        for r in rows:
-            cell = r[col_amt - 1]
-            if has_any_color(cell):
-                continue
-            try:
-                v = parse_amount(cell.value)
-            except Exception:
-                continue
-            if v > 0:
-                pos.append((v, r))
-            elif v < 0:
-                neg.append((v, r))
-
-        used_neg = set()
-        for pval, prow in pos:
-            pc = prow[col_amt - 1]
-            if has_any_color(pc):
-                continue
-            for ni, (nval, nrow) in enumerate(neg):
-                if ni in used_neg:
-                    continue
-                nc = nrow[col_amt - 1]
-                if has_any_color(nc):
-                    continue
-                if abs(pval + nval) <= 2:
-                    pc.fill = ORANGE_FILL
-                    nc.fill = ORANGE_FILL
-                    orange_counts[acc] += 2
-                    used_neg.add(ni)
-                    break
-
-    ensure_summary_sheet(wb, "התאמה 80%", orange_counts)
-
-    # ===== לוגיקה 5 – סגול גלובלי =====
-    purple_counts = defaultdict(int)
-    eligible = []
-
-    for row in ws.iter_rows(min_row=data_start_row):
-        cell = row[col_amt - 1]
-        if has_any_color(cell):
-            continue
-        try:
-            v = parse_amount(cell.value)
-        except Exception:
-            continue
-        if v == 0:
-            continue
-        acc = row[col_acc - 1].value
-        eligible.append((v, acc, row))
+    if progress is None:
+        progress = Progress()
+    progress.start_stage("קריאת גיול", max(0, n_rows - data_start_row + 1))
+
+    records, fill_ids = load_ledger_rows(
+        ws,
+        data_start_row,
+        col_acc=col_acc,
+        col_amt=col_amt,
+        col_type=col_type,
+        col_name=col_name,
+        col_pay=col_pay,
+        progress=progress,
+    )
+    colors = FillStatus.from_fill_ids(fill_ids, ws.parent._fills, data_start_row)
+    audit_rows = read_audit_rows(ws.parent)
 
-    pos = [x for x in eligible if x[0] > 0]
-    neg = [x for x in eligible if x[0] < 0]
+    return Ledger(records, colors, col_amt, data_start_row, company_name, audit_rows)
 
-    used_pos, used_neg = set(), set()
 
-    for pi, (pval, pacc, prow) in enumerate(pos):
-        if pi in used_pos:
-            continue
-        pc = prow[col_amt - 1]
-        if has_any_color(pc):
-            continue
-        for ni, (nval, nacc, nrow) in enumerate(neg):
-            if ni in used_neg:
-                continue
-            nc = nrow[col_amt - 1]
-            if has_any_color(nc):
-                continue
-            if abs(pval + nval) <= 2:
-                pc.fill = PURPLE_FILL
-                nc.fill = PURPLE_FILL
-                used_pos.add(pi)
-                used_neg.add(ni)
-                purple_counts[pacc] += 1
-                purple_counts[nacc] += 1
-                break
-
-    ensure_summary_sheet(wb, "בדיקת ספקים", purple_counts)
-
-    # ===== לוגיקה 6 – כחול: סוג תנועה 'העב' + איסוף למיילים =====
+def match_ledger(ledger, progress=None, plan=None, as_of=None):
+    """
+    מריץ את כללי ההתאמה (ברירת מחדל: לוגיקות 1–6) על הרשומות בלבד,
+    בלי גישה לגיליון. ה-Ledger לא משתנה – הצביעה נעשית על עותק של סטטוס הצבעים.
+    plan – MatchPlan או רשימת כללים (ראו compile_rules).
+    as_of – תאריך הייחוס לדליי הגיול (ברירת מחדל: היום).
+    """
+    if progress is None:
+        progress = Progress()
+    plan = compile_rules(plan)
+
+    records = ledger.records
+    colors = ledger.colors.copy()
+
+    # אינדקסים משותפים – נבנים פעם אחת לכל scope שהתוכנית צריכה
+    supplier_indexes = []
+    if SCOPE_SUPPLIER in plan.scopes:
+        groups = defaultdict(list)
+        for rec in records:
+            groups[rec.acc].append(rec)
+        supplier_indexes = [_SignedIndex(recs) for recs in groups.values()]
+    global_index = _SignedIndex(records) if SCOPE_GLOBAL in plan.scopes else None
+
+    summaries = []
     rows_mail = []
+    pairs = PairLog(ledger.audit_rows)
+
+    for rule in plan.rules:
+        counts = defaultdict(int)
+        stage = pairs.add_stage(rule.name)
+
+        if rule.scope == SCOPE_SUPPLIER:
+            progress.start_stage(rule.name, sum(len(ix.pos) for ix in supplier_indexes))
+            for index in supplier_indexes:
+                _match_pairs(index, rule, stage, colors, counts, pairs, progress)
+        elif rule.scope == SCOPE_GLOBAL:
+            progress.start_stage(rule.name, len(global_index.pos))
+            _match_pairs(global_index, rule, stage, colors, counts, pairs, progress)
+        else:
+            progress.start_stage(rule.name, len(records))
+            _mark_movement(records, rule, stage, colors, counts, pairs, rows_mail, progress)
+
+        if rule.summary:
+            summaries.append((rule.summary, dict(counts)))
+
+    # שורות שלא הותאמו בלוגיקות 1–5 (כללי הזוגות) -> יתרות לפי דליי גיול
+    progress.start_stage("גיול פתוח", 0)
+    matched_colors = {
+        rule.color for rule in plan.rules if rule.scope in (SCOPE_SUPPLIER, SCOPE_GLOBAL)
+    }
+    aging = aging_by_supplier(records, colors, matched_colors, as_of or date.today())
 
-    for row in ws.iter_rows(min_row=data_start_row):
-        if col_type is None:
-            continue
-        tval = row[col_type - 1].value
-        tval = str(tval).strip() if tval is not None else ""
-        cell = row[col_amt - 1]
-        if tval == "העב" and not has_any_color(cell):
-            cell.fill = BLUE_FILL
-            rows_mail.append(
-                (
-                    row[col_name - 1].value,   # שם ספק
-                    row[col_pay - 1].value,    # תאריך תשלום
-                    row[col_amt - 1].value,    # חוב לחשבונית
-                    row[col_acc - 1].value,    # חשבון
-                )
-            )
+    return MatchResult(colors, summaries, rows_mail, pairs, aging)
 
-    # ===== לוגיקה 7 – גיליון 'מיילים לספק' מאוחד לפי חשבון =====
 
-    # קיבוץ לפי חשבון
-    grouped_mail = defaultdict(list)
-    for name, pay, debt, acc in rows_mail:
-        grouped_mail[str(acc).strip()].append((name, pay, debt))
+# תבניות ההודעה – str.format מוכן מראש, במקום f-string מלא לכל הודעה
+MAIL_BODY_TEMPLATE = "שלום ל-{}\nחסרות לנו חשבוניות עבור תשלום:\n{}"
+MAIL_LINE_TEMPLATE = "תאריך - {}\nעל סכום - {}"
+MAIL_SIGNATURE_TEMPLATE = "\nבתודה מראש,\nהנהלת חשבונות של {}"
 
-    if "מיילים לספק" in wb.sheetnames:
-        ws_mail = wb["מיילים לספק"]
-        for r in ws_mail.iter_rows():
-            for c in r:
-                c.value = None
-    else:
-        ws_mail = wb.create_sheet("מיילים לספק")
 
-    ws_mail["A1"] = "שם ספק"
-    ws_mail["B1"] = "טקסט מייל"
-    ws_mail["C1"] = "מייל ספק"
+def _mail_key(rec):
+    return str(rec.acc).strip()
 
-    row_idx = 2
 
-    for acc, entries in grouped_mail.items():
-        name = entries[0][0]
+def sort_mail_rows(rows_mail):
+    """
+    ממיין את שורות 'העב' לפי חשבון, בסדר ההופעה הראשונה של כל חשבון
+    (sort יציב – בתוך חשבון נשמר סדר השורות). מחזיר (רשימה ממוינת, מספר חשבונות).
+    """
+    first = {}
+    for rec in rows_mail:
+        first.setdefault(_mail_key(rec), len(first))
+    return sorted(rows_mail, key=lambda rec: first[_mail_key(rec)]), len(first)
+
 
+def iter_mail_rows(rows_mail, company_name, email_mapping=None, progress=None):
+    """
+    לוגיקה 7 – הודעה מאוחדת לכל חשבון, כ-generator: מעבר אחד על השורות
+    אחרי sort_mail_rows, והודעה אחת בזיכרון בכל רגע.
+    מניב (שם ספק, טקסט מייל, מייל ספק, סוג התאמה).
+    השלב 'מיילים לספק' ב-progress מתחיל רק כשה-generator נצרך לראשונה –
+    בתוך הכתיבה, אחרי ש'כתיבת קובץ' כבר התחיל.
+    """
+    sorted_rows, n_accounts = sort_mail_rows(rows_mail)
+    if progress is not None:
+        progress.start_stage("מיילים לספק", n_accounts)
+    if email_mapping and not isinstance(email_mapping, EmailIndex):
+        email_mapping = EmailIndex.from_mapping(email_mapping)
+
+    body = MAIL_BODY_TEMPLATE.format
+    line = MAIL_LINE_TEMPLATE.format
+    signature = MAIL_SIGNATURE_TEMPLATE.format(company_name)
+    tick = progress.tick if progress is not None else None
+    date_strs = {}  # אותם תאריכי תשלום חוזרים הרבה
+
+    for _, group in groupby(sorted_rows, key=_mail_key):
+        if tick is not None:
+            tick()
         lines = []
-        for _, pay, debt in entries:
+        name = acc = None
+        for rec in group:
+            if not lines:
+                name = rec.name
+                # הערך הגולמי – _mail_key הופך 6341.0 ל-'6341.0' ו-None ל-'None'
+                acc = rec.acc
+            pay = rec.pay
             if isinstance(pay, datetime):
-                date_str = pay.strftime("%d/%m/%y")
+                date_str = date_strs.get(pay)
+                if date_str is None:
+                    date_str = date_strs[pay] = pay.strftime("%d/%m/%y")
             else:
                 date_str = str(pay) if pay else ""
-            try:
-                amount = abs(parse_amount(debt))
-            except Exception:
-                amount = debt
-            lines.append(f"תאריך - {date_str}\nעל סכום - {amount}")
-
-        combined_details = "\n".join(lines)
-
-        msg = (
-            f"שלום ל-{name}\n"
-            f"חסרות לנו חשבוניות עבור תשלום:\n"
-            f"{combined_details}\n"
-            f"בתודה מראש,\n"
-            f"הנהלת חשבונות של {company_name}"
-        )
+            # rec.amount הוא כבר parse_amount(rec.debt)
+            amount = abs(rec.amount) if rec.amount is not None else rec.debt
+            lines.append(line(date_str, amount))
 
-        ws_mail.cell(row_idx, 1, name)
-        cell_msg = ws_mail.cell(row_idx, 2, msg)
-        cell_msg.alignment = Alignment(wrap_text=True)
+        msg = body(name, "\n".join(lines)) + signature
 
-        supplier_email = ""
+        supplier_email, match_type = "", ""
         if email_mapping:
-            supplier_email = email_mapping.get(acc, "")
-            if not supplier_email and name:
-                supplier_email = email_mapping.get(str(name).strip(), "")
+            supplier_email, match_type = email_mapping.lookup(acc, name)
+
+        yield name, msg, supplier_email, match_type
+
+
+def build_mail_rows(rows_mail, company_name, email_mapping=None, progress=None):
+    """
+    לוגיקה 7 – הודעה מאוחדת לכל חשבון.
+    מחזיר רשימת (שם ספק, טקסט מייל, מייל ספק, סוג התאמה).
+    לכמויות גדולות עדיף iter_mail_rows, שלא מחזיק את כל ההודעות בזיכרון.
+    """
+    return list(iter_mail_rows(rows_mail, company_name, email_mapping, progress))
+
+
+def stream_mail_rows(
+    rows_mail,
+    company_name,
+    email_mapping=None,
+    progress=None,
+    mail_sidecar=None,
+    mail_sidecar_format=None,
+):
+    """
+    כמו build_mail_rows, אבל בלי להחזיק את כל ההודעות:
+    - בלי mail_sidecar – מחזיר generator, וההודעות נוצרות תוך כדי כתיבת הגיליון.
+    - עם mail_sidecar (קובץ טקסט פתוח) – ההודעות נכתבות אליו ישר
+      (write_mail_sidecar) ומוחזר None – אין גיליון מיילים, וגיליון מיילים
+      קיים (מהעלאה חוזרת של פלט) מרוקן.
+    """
+    mail_rows = iter_mail_rows(rows_mail, company_name, email_mapping, progress)
+    if mail_sidecar is None:
+        return mail_rows
+    write_mail_sidecar(mail_rows, mail_sidecar, mail_sidecar_format or MAIL_SIDECAR_NDJSON)
+    return None
+
+
+MAIL_SHEET_TITLE = "מיילים לספק"
+MAIL_WRAP_COLUMNS = (2,)  # טקסט המייל
+
+
+MAIL_HEADERS = ["שם ספק", "טקסט מייל", "מייל ספק", "סוג התאמה"]
+MAIL_SIDECAR_NDJSON = "ndjson"
+MAIL_SIDECAR_CSV = "csv"
+MAIL_SIDECAR_FORMATS = (MAIL_SIDECAR_NDJSON, MAIL_SIDECAR_CSV)
+
+
+def mail_sheet_rows(mail_rows):
+    """שורות גיליון 'מיילים לספק' (כולל כותרת) מתוך build_mail_rows / iter_mail_rows, כ-generator."""
+    yield MAIL_HEADERS
+    for name, msg, supplier_email, match_type in mail_rows:
         if supplier_email:
-            ws_mail.cell(row_idx, 3, supplier_email)
+            yield [name, msg, supplier_email, match_type]
+        else:
+            yield [name, msg]
 
-        row_idx += 1
+
+def write_mail_sidecar(mail_rows, fp, fmt=MAIL_SIDECAR_NDJSON):
+    """
+    כותב את ההודעות לקובץ טקסט פתוח (fp), שורה אחרי שורה:
+    ndjson – אובייקט JSON לכל ספק; csv – כותרת ושורה לכל ספק.
+    מחזיר את מספר ההודעות שנכתבו.
+    """
+    if fmt not in MAIL_SIDECAR_FORMATS:
+        raise ValueError(f"פורמט קובץ מיילים לא מוכר: {fmt!r}")
+
+    count = 0
+    if fmt == MAIL_SIDECAR_CSV:
+        writer = csv.writer(fp)
+        writer.writerow(MAIL_HEADERS)
+        for values in mail_rows:
+            writer.writerow(values)
+            count += 1
+        return count
+
+    for values in mail_rows:
+        fp.write(json.dumps(dict(zip(MAIL_HEADERS, values)), ensure_ascii=False, default=str))
+        fp.write("\n")
+        count += 1
+    return count
+
+
+def _clear_or_create_sheet(wb, title):
+    """גיליון קיים – מרוקן ערכים; אחרת נוצר חדש."""
+    if title in wb.sheetnames:
+        ws = wb[title]
+        for r in ws.iter_rows():
+            for c in r:
+                c.value = None
+        return ws
+    return wb.create_sheet(title)
+
+
+def write_results(wb, ledger, result, mail_rows, progress=None):
+    """
+    כותב ל-Workbook את הצבעים, גיליונות הסיכום, 'גיול פתוח', 'מיילים לספק' ויומן ההתאמות.
+    mail_rows=None – ההודעות נכתבו לקובץ נפרד (write_mail_sidecar), בלי גיליון מיילים;
+    גיליון מיילים ישן בקובץ (העלאה חוזרת של פלט) מרוקן, כדי שלא יישארו בו הודעות קודמות.
+    """
+    ws = wb.active
+
+    # גיליון חדש באותו שם של גיליון הגיול היה מרוקן אותו
+    new_titles = [title for title, _ in result.summaries]
+    new_titles += [AGING_SHEET_TITLE, MAIL_SHEET_TITLE, AUDIT_SHEET_TITLE]
+    for title in new_titles:
+        if title.casefold() == ws.title.casefold():
+            raise ValueError(f"גיליון '{title}' באותו שם של גיליון הגיול.")
+
+    if progress is not None:
+        progress.start_stage("כתיבת קובץ", 0)
+
+    result.colors.apply(ws, ledger.col_amt, ledger.colors)
+
+    for title, counts in result.summaries:
+        ensure_summary_sheet(wb, title, counts)
+
+    ws_aging = _clear_or_create_sheet(wb, AGING_SHEET_TITLE)
+    for r, values in enumerate(result.aging.sheet_rows(), start=1):
+        for c, value in enumerate(values, start=1):
+            ws_aging.cell(r, c, value)
+
+    if mail_rows is not None:
+        ws_mail = _clear_or_create_sheet(wb, MAIL_SHEET_TITLE)
+        for r, values in enumerate(mail_sheet_rows(mail_rows), start=1):
+            for c, value in enumerate(values, start=1):
+                cell = ws_mail.cell(r, c, value)
+                if r > 1 and c in MAIL_WRAP_COLUMNS:
+                    cell.alignment = Alignment(wrap_text=True)
+    elif MAIL_SHEET_TITLE in wb.sheetnames:
+        _clear_or_create_sheet(wb, MAIL_SHEET_TITLE)
+
+    # יומן ההתאמות – גיליון מוסתר
+    ws_audit = _clear_or_create_sheet(wb, AUDIT_SHEET_TITLE)
+    for r, values in enumerate(result.pairs.sheet_rows(), start=1):
+        for c, value in enumerate(values, start=1):
+            ws_audit.cell(r, c, value)
+    ws_audit.sheet_state = "hidden"
 
     # RTL לכל הגיליונות
     for sh in wb.worksheets:
         sh.sheet_view.rightToLeft = True
 
+
+def process_workbook(
+    wb,
+    email_mapping=None,
+    progress=None,
+    rules=None,
+    mail_sidecar=None,
+    mail_sidecar_format=None,
+):
+    """
+    מריץ על ה-Workbook את כל הלוגיקות 1–7.
+    email_mapping – EmailIndex (מ-build_email_mapping) או מילון רגיל {חשבון/שם ספק -> מייל}.
+    progress – Progress אופציונלי לדיווח התקדמות ולביטול (זורק ProcessCancelled).
+    rules – רשימת כללי התאמה במקום DEFAULT_RULES (ראו compile_rules).
+    mail_sidecar – קובץ טקסט פתוח להודעות (ndjson / csv) במקום גיליון 'מיילים לספק'.
+    """
+    if progress is None:
+        progress = Progress()
+    ledger = parse_ledger(wb.active, progress)  # הגיליון הראשון הוא המקור
+    result = match_ledger(ledger, progress, plan=rules)
+    mail_rows = stream_mail_rows(
+        result.rows_mail,
+        ledger.company_name,
+        email_mapping,
+        progress,
+        mail_sidecar,
+        mail_sidecar_format,
+    )
+    write_results(wb, ledger, result, mail_rows, progress)
     return wb
 
 
+# ---------- כתיבת התוצאה לקובץ ----------
+
+OUTPUT_PATCH = "patch"        # patch על ה-xlsx המקורי (xlsx_patch)
+OUTPUT_OPENPYXL = "openpyxl"  # טעינה מלאה ושמירה דרך openpyxl
+OUTPUT_MODES = (OUTPUT_PATCH, OUTPUT_OPENPYXL)
+
+
+def render_output(source_bytes, ledger, result, mail_rows, progress=None, output_mode=OUTPUT_PATCH):
+    """
+    bytes של הקובץ המעובד.
+    במצב patch רק תאי הסכום שנצבעו והגיליונות החדשים נכתבים, וכל השאר
+    מועתק מהקובץ המקורי – הזמן תלוי בכמות השינויים ולא בגודל הגיליון.
+    אם מבנה הקובץ לא נתמך ל-patch – חוזרים לשמירה דרך openpyxl.
+    mail_rows יכול להיות generator (stream_mail_rows) – הוא נצרך רק בזמן הכתיבה,
+    ו-patch_xlsx לא נכשל אחרי שהתחיל לצרוך אותו.
+    """
+    if progress is not None:
+        progress.start_stage("כתיבת קובץ", 0)
+
+    if output_mode == OUTPUT_PATCH:
+        fills = {
+            row: RGB_BY_STATUS[code]
+            for row, code in result.colors.changes(ledger.colors)
+        }
+        new_sheets = [
+            (title, summary_sheet_rows(counts), ())
+            for title, counts in result.summaries
+        ]
+        new_sheets.append((AGING_SHEET_TITLE, result.aging.sheet_rows(), ()))
+        clear = ()
+        if mail_rows is not None:
+            new_sheets.append((MAIL_SHEET_TITLE, mail_sheet_rows(mail_rows), MAIL_WRAP_COLUMNS))
+        else:
+            clear = (MAIL_SHEET_TITLE,)  # גיליון מיילים ישן – ראו write_results
+        new_sheets.append((AUDIT_SHEET_TITLE, result.pairs.sheet_rows(), ()))
+        try:
+            return patch_xlsx(
+                source_bytes,
+                ledger.col_amt,
+                fills,
+                new_sheets,
+                hidden={AUDIT_SHEET_TITLE},
+                clear=clear,
+            )
+        except XlsxPatchError:
+            pass
+
+    wb = openpyxl.load_workbook(io.BytesIO(source_bytes))
+    write_results(wb, ledger, result, mail_rows)
+    output = io.BytesIO()
+    wb.save(output)
+    return output.getvalue()
+
+
+def process_file(
+    source_bytes,
+    email_mapping=None,
+    progress=None,
+    rules=None,
+    output_mode=OUTPUT_PATCH,
+    source_wb=None,
+    mail_sidecar=None,
+    mail_sidecar_format=None,
+):
+    """
+    process_workbook על קובץ: מקבל bytes של גיול ומחזיר bytes של הקובץ המעובד.
+    במצב patch הגיול נקרא ב-read_only והפלט נכתב כ-patch (ראו render_output).
+    source_wb – Workbook של source_bytes שכבר נטען ב-read_only (אופציונלי).
+    mail_sidecar / mail_sidecar_format – ראו stream_mail_rows.
+    """
+    if output_mode not in OUTPUT_MODES:
+        raise ValueError(f"output_mode לא מוכר: {output_mode!r}")
+    if mail_sidecar_format is not None and mail_sidecar_format not in MAIL_SIDECAR_FORMATS:
+        raise ValueError(f"פורמט קובץ מיילים לא מוכר: {mail_sidecar_format!r}")
+    if progress is None:
+        progress = Progress()
+
+    if output_mode == OUTPUT_OPENPYXL:
+        if source_wb is not None:
+            source_wb.close()
+        wb = openpyxl.load_workbook(io.BytesIO(source_bytes))
+        process_workbook(
+            wb,
+            email_mapping=email_mapping,
+            progress=progress,
+            rules=rules,
+            mail_sidecar=mail_sidecar,
+            mail_sidecar_format=mail_sidecar_format,
+        )
+        output = io.BytesIO()
+        wb.save(output)
+        return output.getvalue()
+
+    if source_wb is None:
+        source_wb = openpyxl.load_workbook(io.BytesIO(source_bytes), read_only=True)
+    try:
+        ledger = parse_ledger(source_wb.active, progress)
+    finally:
+        source_wb.close()
+
+    result = match_ledger(ledger, progress, plan=rules)
+    mail_rows = stream_mail_rows(
+        result.rows_mail,
+        ledger.company_name,
+        email_mapping,
+        progress,
+        mail_sidecar,
+        mail_sidecar_format,
+    )
+    return render_output(source_bytes, ledger, result, mail_rows, progress, output_mode)
+
+
 # ---------- טריגר ל-N8N ----------
 
 def trigger_n8n(client_name: str):
@@ -416,6 +1418,88 @@ def trigger_n8n(client_name: str):
     return resp
 
 
+# ---------- מטמון שלבים (Streamlit) ----------
+# כל rerun של Streamlit (לחיצה על כפתור, שינוי ווידג'ט) מריץ את הסקריפט מחדש.
+# כל שלב נשמר ב-st.session_state לפי hash של תוכן הקבצים שהוא תלוי בהם, כך
+# ששינוי קובץ העזר מריץ מחדש רק את מיפוי המיילים ולוגיקה 7, ולא את קריאת
+# הגיול וההתאמות. המטמון שייך ל-session, ולכן כמה משתמשים במקביל לא חולקים
+# אובייקטים. ההתאמה והפלט תלויים גם בתאריך (דליי 'גיול פתוח'), ולכן היום
+# הוא חלק מהמפתח שלהם – session שנשאר פתוח אחרי חצות לא מחזיר גיול של אתמול.
+# (לא st.cache_data – פונקציה שמורה לא יכולה לעדכן את st.progress
+# שנוצר מחוץ לה.)
+
+def content_digest(data):
+    """sha256 של תוכן קובץ שהועלה."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def session_cached(stage, key, compute):
+    """
+    מחזיר את הערך השמור של stage אם נשמר עם אותו key, אחרת מחשב ושומר.
+    נשמר רק הערך האחרון לכל שלב, כך שהזיכרון חסום.
+    """
+    cache = st.session_state.setdefault("stage_cache", {})
+    hit = cache.get(stage)
+    if hit is not None and hit[0] == key:
+        return hit[1]
+    value = compute()
+    cache[stage] = (key, value)
+    return value
+
+
+def run_cached_pipeline(ledger_bytes, helper_bytes, progress=None):
+    """הקובץ המעובד (bytes) עבור צירוף של גיול + קובץ עזר, עם מטמון לכל שלב."""
+    ledger_digest = content_digest(ledger_bytes)
+    helper_digest = content_digest(helper_bytes) if helper_bytes is not None else None
+
+    def load_ledger():
+        wb = openpyxl.load_workbook(io.BytesIO(ledger_bytes), read_only=True)
+        try:
+            return parse_ledger(wb.active, progress)
+        finally:
+            wb.close()
+
+    as_of = date.today()
+
+    ledger = session_cached("ledger", ledger_digest, load_ledger)
+    result = session_cached(
+        "match", (ledger_digest, as_of), lambda: match_ledger(ledger, progress, as_of=as_of)
+    )
+
+    email_mapping = None
+    if helper_digest is not None:
+        email_mapping = session_cached(
+            "email_index",
+            helper_digest,
+            lambda: build_email_mapping(io.BytesIO(helper_bytes)),
+        )
+
+    def output():
+        mail_rows = stream_mail_rows(
+            result.rows_mail, ledger.company_name, email_mapping, progress
+        )
+        return render_output(ledger_bytes, ledger, result, mail_rows, progress)
+
+    return session_cached("output", (ledger_digest, helper_digest, as_of), output)
+
+
+def show_progress(bar):
+    """callback ל-Progress שמעדכן st.progress."""
+
+    def update(progress):
+        fraction = progress.done / progress.total if progress.total else 0.0
+        text = (
+            f"{progress.stage}: {progress.done:,}/{progress.total:,} "
+            f"· שורות מסומנות: {progress.matches:,}"
+        )
+        eta = progress.eta
+        if eta is not None:
+            text += f" · נותרו כ-{eta:.0f} שניות"
+        bar.progress(min(fraction, 1.0), text=text)
+
+    return update
+
+
 # ---------- אפליקציית Streamlit ----------
 
 def main():
@@ -461,17 +1545,17 @@ def main():
         return
 
     if st.button("הפעל אוטומציה על הקובץ"):
+        # לחיצה על עצירה גורמת ל-rerun, ו-Streamlit עוצר את הריצה הנוכחית
+        # בעדכון הבא של פס ההתקדמות
+        st.button("⏹️ עצירת הריצה")
+        bar = st.progress(0.0, text="מתחיל...")
         try:
-            email_mapping = None
-            if helper_file is not None:
-                email_mapping = build_email_mapping(helper_file)
-
-            wb = openpyxl.load_workbook(uploaded_file)
-            wb = process_workbook(wb, email_mapping=email_mapping)
-
-            output = io.BytesIO()
-            wb.save(output)
-            output.seek(0)
+            output = run_cached_pipeline(
+                uploaded_file.getvalue(),
+                helper_file.getvalue() if helper_file is not None else None,
+                progress=Progress(callback=show_progress(bar)),
+            )
+            bar.empty()
 
             st.success("✅ האוטומציה הסתיימה, אפשר להוריד את הקובץ המעודכן.")
             st.download_button(
@@ -0,0 +1,554 @@
+# xlsx_patch.py
+"""
+כתיבת תוצאת העיבוד כ-patch על קובץ ה-xlsx המקורי, בלי openpyxl.
+
+כל חלקי ה-zip מועתקים כמו שהם (התוכן לא משתנה). מה שכן משתנה:
+- גיליון הגיול: מעבר זורם (streaming) על ה-XML, ורק בשורות שיש בהן
+  תא לצביעה מוחלף אינדקס הסגנון (s) של תא הסכום.
+- styles.xml: נוספים מילויים ו-xf חדשים (העתק של ה-xf המקורי עם fillId אחר).
+- גיליונות חדשים (סיכומים / מיילים / יומן התאמות) נכתבים כחלקים חדשים
+  עם inline strings, ונרשמים ב-workbook.xml, ב-rels וב-[Content_Types].xml.
+  גיליון יכול להיות מוסתר (state="hidden").
+- rightToLeft בכל הגיליונות.
+
+כשמבנה הקובץ לא נתמך (למשל תאים בלי r) נזרק XlsxPatchError,
+והקורא אמור לחזור לשמירה הרגילה דרך openpyxl.
+"""
+import io
+import re
+import shutil
+import time
+import zipfile
+from xml.sax.saxutils import escape, quoteattr, unescape
+
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.utils import column_index_from_string, get_column_letter
+
+NS_MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+NS_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+REL_WORKSHEET = NS_REL + "/worksheet"
+REL_STYLES = NS_REL + "/styles"
+REL_OFFICE_DOCUMENT = NS_REL + "/officeDocument"
+CT_WORKSHEET = "application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"
+
+CHUNK_SIZE = 1 << 20
+
+_ATTR_RE = re.compile(rb'([\w:.-]+)\s*=\s*"([^"]*)"')
+_ROOT_RELS_RE = re.compile(rb"<(?:[\w.-]+:)?Relationship\b[^>]*?/>")
+
+
+class XlsxPatchError(Exception):
+    """מבנה הקובץ לא נתמך לכתיבה כ-patch."""
+
+
+def _attrs(tag):
+    return {k.decode(): v.decode() for k, v in _ATTR_RE.findall(tag)}
+
+
+def _unescape_attr(value):
+    return unescape(value, {"&quot;": '"', "&apos;": "'"})
+
+
+def _set_attr(tag, name, value):
+    """קובע/מחליף מאפיין בתג פתיחה (bytes, בלי ה-> הסוגר)."""
+    pattern = re.compile(rb"\s" + re.escape(name) + rb'="[^"]*"')
+    new = b" " + name + b'="' + value + b'"'
+    if pattern.search(tag):
+        return pattern.sub(new, tag, count=1)
+    return tag + new
+
+
+def _part_path(base_dir, target):
+    """נתיב החלק בתוך ה-zip לפי Target של rels (יחסי או מוחלט)."""
+    if target.startswith("/"):
+        return target.lstrip("/")
+    parts = [p for p in (base_dir + "/" + target).split("/") if p]
+    out = []
+    for p in parts:
+        if p == "..":
+            if out:
+                out.pop()
+        elif p != ".":
+            out.append(p)
+    return "/".join(out)
+
+
+def _rels_path(part):
+    base, _, name = part.rpartition("/")
+    return f"{base}/_rels/{name}.rels" if base else f"_rels/{name}.rels"
+
+
+def _read_rels(zin, part):
+    """{Id: (Type, נתיב החלק)} עבור קובץ rels של part."""
+    path = _rels_path(part)
+    try:
+        data = zin.read(path)
+    except KeyError:
+        raise XlsxPatchError(f"חסר {path}")
+    base_dir = part.rpartition("/")[0]
+    rels = {}
+    for tag in _ROOT_RELS_RE.findall(data):
+        a = _attrs(tag)
+        if a.get("TargetMode") == "External":
+            continue
+        rels[a.get("Id")] = (a.get("Type"), _part_path(base_dir, a.get("Target", "")))
+    return rels, data
+
+
+# ---------- סגנונות ----------
+
+class _Styles:
+    """
+    מוסיף ל-styles.xml מילויים ו-xf חדשים, עם מטמון:
+    (סגנון מקורי, צבע) -> אינדקס xf חדש.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.fills_m = re.search(rb"<(?:[\w.-]+:)?fills\b[^>]*>(.*?)</(?:[\w.-]+:)?fills>", data, re.S)
+        self.xfs_m = re.search(rb"<(?:[\w.-]+:)?cellXfs\b[^>]*>(.*?)</(?:[\w.-]+:)?cellXfs>", data, re.S)
+        if self.fills_m is None or self.xfs_m is None:
+            raise XlsxPatchError("styles.xml בלי fills/cellXfs במבנה מוכר")
+        if re.search(rb"<[\w.-]+:(?:fills|cellXfs)\b", data):
+            raise XlsxPatchError("styles.xml עם prefix לא נתמך")
+
+        self.fill_count = len(re.findall(rb"<fill\b", self.fills_m.group(1)))
+        self.xfs = re.findall(rb"<xf\b[^>]*?(?:/>|>.*?</xf>)", self.xfs_m.group(1), re.S)
+        self.new_fills = []
+        self.new_xfs = []
+        self._fill_ids = {}
+        self._xf_ids = {}
+        self._wrap_xf = None
+
+    def fill_xf(self, style_id, rgb):
+        key = (style_id, rgb)
+        xf_id = self._xf_ids.get(key)
+        if xf_id is not None:
+            return xf_id
+
+        fill_id = self._fill_ids.get(rgb)
+        if fill_id is None:
+            fill_id = self._fill_ids[rgb] = self.fill_count + len(self.new_fills)
+            rgb_b = rgb.encode()
+            self.new_fills.append(
+                b'<fill><patternFill patternType="solid"><fgColor rgb="' + rgb_b
+                + b'"/><bgColor rgb="' + rgb_b + b'"/></patternFill></fill>'
+            )
+
+        if style_id >= len(self.xfs):
+            raise XlsxPatchError(f"סגנון תא {style_id} לא קיים ב-cellXfs")
+        xf = self.xfs[style_id]
+        end = xf.index(b">")
+        if xf[end - 1:end] == b"/":
+            start_tag, rest = xf[:end - 1], b"/>"
+        else:
+            start_tag, rest = xf[:end], xf[end:]
+        start_tag = _set_attr(start_tag, b"fillId", str(fill_id).encode())
+        start_tag = _set_attr(start_tag, b"applyFill", b"1")
+
+        xf_id = self._xf_ids[key] = len(self.xfs) + len(self.new_xfs)
+        self.new_xfs.append(start_tag + rest)
+        return xf_id
+
+    def wrap_xf(self):
+        """xf לטקסט עם גלישת שורות (כמו Alignment(wrap_text=True))."""
+        if self._wrap_xf is None:
+            self._wrap_xf = len(self.xfs) + len(self.new_xfs)
+            self.new_xfs.append(
+                b'<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0" '
+                b'applyAlignment="1"><alignment wrapText="1"/></xf>'
+            )
+        return self._wrap_xf
+
+    def render(self):
+        data = self.data
+        # מהסוף להתחלה, כדי שהאינדקסים של ההתאמה הראשונה לא יזוזו
+        for m, new, count in sorted(
+            (
+                (self.xfs_m, self.new_xfs, len(self.xfs) + len(self.new_xfs)),
+                (self.fills_m, self.new_fills, self.fill_count + len(self.new_fills)),
+            ),
+            key=lambda x: x[0].start(),
+            reverse=True,
+        ):
+            if not new:
+                continue
+            block = m.group(0)
+            open_end = block.index(b">") + 1
+            close_start = block.rindex(b"</")
+            open_tag = _set_attr(block[:open_end - 1], b"count", str(count).encode()) + b">"
+            block = open_tag + block[open_end:close_start] + b"".join(new) + block[close_start:]
+            data = data[:m.start()] + block + data[m.end():]
+        return data
+
+
+# ---------- גיליון קיים: RTL + החלפת סגנון בתאים ----------
+
+def _patch_sheet_views(header, right_to_left):
+    """rightToLeft="1" ב-sheetView (או sheetViews חדש אם אין)."""
+    if not right_to_left:
+        return header
+    m = re.search(rb"<((?:[\w.-]+:)?)sheetView\b([^>]*?)(/?)>", header)
+    if m:
+        tag = _set_attr(m.group(0)[: m.end(2) - m.start(0)], b"rightToLeft", b"1")
+        return header[: m.start()] + tag + m.group(3) + b">" + header[m.end():]
+
+    anchor = re.search(rb"<((?:[\w.-]+:)?)(?:sheetFormatPr|cols|sheetData)\b", header)
+    if anchor is None:
+        raise XlsxPatchError("לא נמצא מקום ל-sheetViews")
+    p = anchor.group(1)
+    views = (
+        b"<" + p + b"sheetViews><" + p + b'sheetView rightToLeft="1" workbookViewId="0"/></'
+        + p + b"sheetViews>"
+    )
+    return header[: anchor.start()] + views + header[anchor.start():]
+
+
+class _RowPatcher:
+    """
+    מחליף את s של תא אחד (עמודה column) בשורות שב-fills.
+    השורות לצביעה נמצאות ב-bytes.find על r="N" של תג השורה, לפי הסדר;
+    כל מה שביניהן מועתק כמו שהוא, בלי regex ובלי קוד Python לכל שורה.
+    """
+
+    def __init__(self, prefix, column, fills, styles):
+        p = re.escape(prefix)
+        self.row_re = re.compile(rb"<" + p + rb"row\b([^>]*?)(/>|>(.*?)</" + p + rb"row>)", re.S)
+        self.cell_re = re.compile(rb"<" + p + rb"c\b([^>]*?)(/>|>.*?</" + p + rb"c>)", re.S)
+        self.prefix = prefix
+        self.row_open = b"<" + prefix + b"row"
+        self.column = column
+        self.letter = get_column_letter(column).encode()
+        self.pending = dict(fills)   # row -> rgb
+        self.order = sorted(fills)   # השורות לצביעה, בסדר שבו הן מופיעות ב-XML
+        self.next = 0
+        self.styles = styles
+
+    def __call__(self, region):
+        """region – רצף שורות שלמות (עד </row>)."""
+        out = []
+        pos = 0
+        while self.next < len(self.order):
+            row = self.order[self.next]
+            m = self._find_row(region, pos, row)
+            if m is None:
+                break  # השורה בחתיכה הבאה (או חסרה – ואז XlsxPatchError בסוף)
+            out.append(region[pos: m.start()])
+            out.append(self._row(m, row))
+            pos = m.end()
+            self.next += 1
+        if not out:
+            return region
+        out.append(region[pos:])
+        return b"".join(out)
+
+    def _find_row(self, region, pos, row):
+        needle = b' r="' + str(row).encode() + b'"'
+        while True:
+            found = region.find(needle, pos)
+            if found < 0:
+                return None
+            # רק בתוך תג פתיחה של row (ולא, למשל, בטקסט של inline string)
+            start = region.rfind(self.row_open, pos, found)
+            if start >= 0 and region.find(b">", start, found) < 0:
+                m = self.row_re.match(region, start)
+                if m is not None:
+                    return m
+            pos = found + len(needle)
+
+    def _row(self, m, row):
+        rgb = self.pending.pop(row)
+        r = str(row).encode()
+        ref = self.letter + r
+        body = m.group(3) or b""
+        cell_m = None
+        insert_at = len(body)
+
+        # מסלול מהיר: התא קיים – קפיצה ישירה אליו לפי r="..."
+        pos = body.find(b'r="' + ref + b'"')
+        if pos >= 0:
+            start = body.rfind(b"<" + self.prefix + b"c", 0, pos)
+            c = self.cell_re.match(body, start) if start >= 0 else None
+            if c is not None and _attrs(c.group(1)).get("r", "").encode() == ref:
+                cell_m = c
+
+        if cell_m is None:
+            # התא לא קיים – מוצאים איפה להכניס אותו לפי סדר העמודות
+            for c in self.cell_re.finditer(body):
+                cref = _attrs(c.group(1)).get("r")
+                if cref is None:
+                    raise XlsxPatchError("תא בלי מאפיין r")
+                if column_index_from_string(cref.rstrip("0123456789")) > self.column:
+                    insert_at = c.start()
+                    break
+
+        if cell_m is not None:
+            style_id = int(_attrs(cell_m.group(1)).get("s", 0))
+            new_s = str(self.styles.fill_xf(style_id, rgb)).encode()
+            head = b"<" + self.prefix + b"c" + _set_attr(cell_m.group(1), b"s", new_s)
+            body = body[: cell_m.start()] + head + cell_m.group(2) + body[cell_m.end():]
+        else:
+            new_s = str(self.styles.fill_xf(0, rgb)).encode()
+            cell = b"<" + self.prefix + b'c r="' + ref + b'" s="' + new_s + b'"/>'
+            body = body[:insert_at] + cell + body[insert_at:]
+
+        p = self.prefix
+        return b"<" + p + b"row" + m.group(1) + b">" + body + b"</" + p + b"row>"
+
+
+def _rewrite_sheet(src, dst, right_to_left, column=None, fills=None, styles=None):
+    """
+    מעתיק XML של גיליון מ-src ל-dst בחתיכות. רק הכותרת (עד sheetData) נכתבת
+    מחדש בשביל RTL; בשורות מטפלים רק עד ה-</row> האחרון בכל חתיכה, וכשאין
+    יותר שורות לצביעה שאר הגיליון מועתק ב-copyfileobj.
+    """
+    buf = b""
+    patcher = None
+    for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+        buf += chunk
+        if patcher is None:
+            m = re.search(rb"<((?:[\w.-]+:)?)sheetData\b", buf)
+            if m is None:
+                continue
+            dst.write(_patch_sheet_views(buf[: m.start()], right_to_left))
+            buf = buf[m.start():]
+            patcher = _RowPatcher(m.group(1), column or 1, fills or {}, styles)
+            close_row = b"</" + m.group(1) + b"row>"
+        if not patcher.pending:
+            break
+        cut = buf.rfind(close_row)
+        if cut >= 0:
+            cut += len(close_row)
+            dst.write(patcher(buf[:cut]))
+            buf = buf[cut:]
+
+    if patcher is None:
+        raise XlsxPatchError("גיליון בלי sheetData")
+    if patcher.pending:
+        buf = patcher(buf)
+    dst.write(buf)
+    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    if patcher.pending:
+        raise XlsxPatchError(f"{len(patcher.pending)} שורות לצביעה לא נמצאו ב-XML")
+
+
+# ---------- גיליונות חדשים ----------
+
+def _cell_xml(ref, value, style_id=None):
+    s = f' s="{style_id}"' if style_id is not None else ""
+    if isinstance(value, bool):
+        return f'<c r="{ref}" t="b"{s}><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c r="{ref}"{s}><v>{value!r}</v></c>'
+    text = ILLEGAL_CHARACTERS_RE.sub("", str(value))
+    return (
+        f'<c r="{ref}" t="inlineStr"{s}><is><t xml:space="preserve">'
+        f"{escape(text)}</t></is></c>"
+    )
+
+
+def _new_sheet_xml(rows, wrap_columns, wrap_style, right_to_left):
+    """
+    XML של גיליון חדש כ-generator של חלקים (bytes). rows יכול להיות generator –
+    השורות נצרכות רק בזמן הכתיבה ל-zip, ובזיכרון יש רק חלק אחד בכל פעם.
+    """
+    rtl = ' rightToLeft="1"' if right_to_left else ""
+    out = [
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n',
+        f'<worksheet xmlns="{NS_MAIN}" xmlns:r="{NS_REL}">',
+        f'<sheetViews><sheetView{rtl} workbookViewId="0"/></sheetViews>',
+        "<sheetData>",
+    ]
+    size = 0
+    for r, values in enumerate(rows, start=1):
+        cells = []
+        for c, value in enumerate(values, start=1):
+            if value is None:
+                continue
+            ref = f"{get_column_letter(c)}{r}"
+            style = wrap_style if (c in wrap_columns and r > 1) else None
+            cells.append(_cell_xml(ref, value, style))
+        if cells:
+            row_xml = f'<row r="{r}">{"".join(cells)}</row>'
+            out.append(row_xml)
+            size += len(row_xml)
+            if size >= CHUNK_SIZE:
+                yield "".join(out).encode("utf-8")
+                out, size = [], 0
+    out.append("</sheetData></worksheet>")
+    yield "".join(out).encode("utf-8")
+
+
+def _write_chunks(zout, target, chunks):
+    with zout.open(target, "w") as dst:
+        for chunk in chunks:
+            dst.write(chunk)
+
+
+# ---------- הרכבת הקובץ ----------
+
+def patch_xlsx(source, column, fills, new_sheets, right_to_left=True, hidden=(), clear=()):
+    """
+    source      – bytes של קובץ ה-xlsx המקורי.
+    column      – עמודת הסכום (1-based) בגיליון הפעיל.
+    fills       – {מספר שורה: ARGB} לתאים שצריך לצבוע בגיליון הפעיל.
+    new_sheets  – [(שם גיליון, שורות, עמודות עם wrap_text)]; גיליון קיים
+                  באותו שם מוחלף בתוכן החדש. השורות יכולות להיות generator.
+    hidden      – שמות גיליונות (מתוך new_sheets) שיסומנו כמוסתרים.
+    clear       – שמות גיליונות קיימים לריקון (כמו _clear_or_create_sheet);
+                  שם שאין בקובץ מדולג, לא נוצר גיליון חדש.
+    מחזיר bytes של הקובץ החדש.
+    """
+    zin = zipfile.ZipFile(io.BytesIO(source))
+    names = set(zin.namelist())
+
+    root_rels, _ = _read_rels(zin, "")
+    wb_part = next(
+        (path for typ, path in root_rels.values() if typ == REL_OFFICE_DOCUMENT), None
+    )
+    if wb_part is None or wb_part not in names:
+        raise XlsxPatchError("לא נמצא workbook.xml")
+    wb_dir = wb_part.rpartition("/")[0]
+    wb_xml = zin.read(wb_part)
+    wb_rels, wb_rels_xml = _read_rels(zin, wb_part)
+
+    styles_part = next((path for typ, path in wb_rels.values() if typ == REL_STYLES), None)
+    if styles_part is None or styles_part not in names:
+        raise XlsxPatchError("לא נמצא styles.xml")
+    styles = _Styles(zin.read(styles_part))
+
+    # הגיליונות לפי הסדר ב-workbook.xml; הפעיל לפי activeTab (כמו wb.active)
+    sheets = []
+    for tag in re.findall(rb"<(?:[\w.-]+:)?sheet\b[^>]*?/>", wb_xml):
+        a = _attrs(tag)
+        rid = next((v for k, v in a.items() if k.endswith(":id")), None)
+        typ, path = wb_rels.get(rid, (None, None))
+        name = _unescape_attr(a.get("name", ""))
+        sheets.append((name, int(a.get("sheetId", 0)), typ, path))
+    view = re.search(rb"<(?:[\w.-]+:)?workbookView\b[^>]*?/?>", wb_xml)
+    active = int(_attrs(view.group(0)).get("activeTab", 0)) if view else 0
+    if not sheets or active >= len(sheets) or sheets[active][2] != REL_WORKSHEET:
+        raise XlsxPatchError("הגיליון הפעיל אינו worksheet")
+    active_part = sheets[active][3]
+
+    # גיליונות חדשים / מוחלפים. Excel משווה שמות גיליונות בלי תלות ב-case;
+    # גיליון הגיול עצמו ושם כפול ב-new_sheets הם שגיאה של הקורא, לא מבנה לא נתמך
+    active_key = sheets[active][0].casefold()
+    seen = set()
+    for title in [t for t, _, _ in new_sheets] + list(clear):
+        key = title.casefold()
+        if key == active_key:
+            raise ValueError(f"גיליון חדש '{title}' באותו שם של גיליון הגיול.")
+        if key in seen:
+            raise ValueError(f"גיליון '{title}' מופיע פעמיים ב-new_sheets.")
+        seen.add(key)
+    by_name = {
+        name.casefold(): path for name, _, typ, path in sheets if typ == REL_WORKSHEET
+    }
+    replaced = {}
+    added = []
+    next_sheet_id = max(sid for _, sid, _, _ in sheets) + 1
+    rel_nums = [int(x) for x in re.findall(rb'Id="rId(\d+)"', wb_rels_xml)]
+    next_rel = max(rel_nums, default=0) + 1
+    n = 1
+    for title, rows, wrap_columns in new_sheets:
+        wrap_style = styles.wrap_xf() if wrap_columns else None
+        chunks = _new_sheet_xml(rows, set(wrap_columns), wrap_style, right_to_left)
+        if title.casefold() in by_name:
+            replaced[by_name[title.casefold()]] = chunks
+            continue
+        while f"{wb_dir}/worksheets/sheet{n}.xml" in names:
+            n += 1
+        path = f"{wb_dir}/worksheets/sheet{n}.xml"
+        names.add(path)
+        added.append((title, next_sheet_id, f"rId{next_rel}", path, chunks))
+        next_sheet_id += 1
+        next_rel += 1
+    for title in clear:
+        path = by_name.get(title.casefold())
+        if path is not None:
+            replaced[path] = _new_sheet_xml((), set(), None, right_to_left)
+
+    if added:
+        sheets_m = re.search(rb"<((?:[\w.-]+:)?)sheets\b[^>]*>.*?</(?:[\w.-]+:)?sheets>", wb_xml, re.S)
+        if sheets_m is None:
+            raise XlsxPatchError("workbook.xml בלי sheets")
+        p = sheets_m.group(1).decode()
+        entries = "".join(
+            f'<{p}sheet xmlns:r="{NS_REL}" name={quoteattr(title)} sheetId="{sid}" r:id="{rid}"/>'
+            for title, sid, rid, _, _ in added
+        ).encode("utf-8")
+        close = sheets_m.group(0).rindex(b"</") + sheets_m.start()
+        wb_xml = wb_xml[:close] + entries + wb_xml[close:]
+
+        rels_close = wb_rels_xml.rindex(b"</")
+        rel_entries = "".join(
+            f'<Relationship Id="{rid}" Type="{REL_WORKSHEET}" '
+            f'Target="{path[len(wb_dir) + 1:] if wb_dir else path}"/>'
+            for _, _, rid, path, _ in added
+        ).encode("utf-8")
+        wb_rels_xml = wb_rels_xml[:rels_close] + rel_entries + wb_rels_xml[rels_close:]
+
+    if hidden:
+        def _hide(m):
+            tag = m.group(0)
+            name = _unescape_attr(_attrs(tag).get("name", ""))
+            if name not in hidden:
+                return tag
+            return _set_attr(tag[:-2].rstrip(), b"state", b"hidden") + b"/>"
+
+        wb_xml = re.sub(rb"<(?:[\w.-]+:)?sheet\b[^>]*?/>", _hide, wb_xml)
+
+    ct_xml = zin.read("[Content_Types].xml")
+    if added:
+        ct_close = ct_xml.rindex(b"</")
+        overrides = "".join(
+            f'<Override PartName="/{path}" ContentType="{CT_WORKSHEET}"/>'
+            for _, _, _, path, _ in added
+        ).encode("utf-8")
+        ct_xml = ct_xml[:ct_close] + overrides + ct_xml[ct_close:]
+
+    small_parts = {
+        "[Content_Types].xml": ct_xml,
+        wb_part: wb_xml,
+        _rels_path(wb_part): wb_rels_xml,
+    }
+    other_worksheets = {
+        path for _, _, typ, path in sheets
+        if typ == REL_WORKSHEET and path != active_part and path not in replaced
+    }
+
+    replaced_info = {}
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zout:
+        for info in zin.infolist():
+            name = info.filename
+            if name == styles_part:
+                continue  # נכתב בסוף, אחרי שכל הסגנונות החדשים ידועים
+            target = zipfile.ZipInfo(name, info.date_time)
+            target.compress_type = zipfile.ZIP_DEFLATED
+            target.external_attr = info.external_attr
+
+            if name in small_parts:
+                zout.writestr(target, small_parts[name])
+            elif name in replaced:
+                replaced_info[name] = target  # נכתב אחרי שאר החלקים
+            elif name == active_part or (right_to_left and name in other_worksheets):
+                fills_here = fills if name == active_part else None
+                with zin.open(info) as src, zout.open(target, "w") as dst:
+                    _rewrite_sheet(src, dst, right_to_left, column, fills_here, styles)
+            else:
+                with zin.open(info) as src, zout.open(target, "w") as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+        # הגיליונות החדשים/המוחלפים אחרונים: XlsxPatchError יכול לקרות רק
+        # בשלב הקודם, כך שה-rows שלהם (אולי generator) לא נצרכים לשווא
+        for path, chunks in replaced.items():
+            _write_chunks(zout, replaced_info[path], chunks)
+        for _, _, _, path, chunks in added:
+            target = zipfile.ZipInfo(path, time.localtime()[:6])
+            target.compress_type = zipfile.ZIP_DEFLATED
+            _write_chunks(zout, target, chunks)
+        zout.writestr(styles_part, styles.render())
+
+    return out.getvalue()